@@ -19,6 +19,7 @@ setup(name=pname,
       long_description=open('README.md').read(),
       packages=[pname],
       install_requires=['pyyaml'],
+      extras_require={'gevent': ['gevent']},
       data_files=rqfiles,
       include_package_data=True,
       entry_points={'console_scripts': ['%s=%s.cli:main' % (pname, pname)]},
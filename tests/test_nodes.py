@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from timmy import tools
+from timmy.conf import load_conf
+from timmy.nodes import ConfIndex, Node
+
+
+class LogsSampleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for i in range(2):
+            self.files.append(os.path.join(self.dir, 'log%s' % i))
+            with open(self.files[-1], 'w') as f:
+                f.write('line\n' * 1000)
+        self.node = Node(id=1, mac='n/a', cluster=1, roles=['controller'],
+                         os_platform='ubuntu', online=True, status='ready',
+                         ip='127.0.0.1', conf=load_conf(None))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_prefix_applies_to_all_files(self):
+        cmd = self.node.logs_sample_cmd(self.files, 1000)
+        self.assertTrue(cmd.startswith('bash -c '))
+        self.assertNotIn('\n', cmd)
+        # prefix fails every command it applies to
+        outs, errs, code = tools.ssh_node('127.0.0.1', command=cmd,
+                                          prefix='false &&')
+        self.assertEqual(outs, '')
+        outs, errs, code = tools.ssh_node('127.0.0.1', command=cmd,
+                                          prefix=self.node.prefix)
+        lines = [line.split() for line in outs.splitlines()]
+        self.assertEqual(len(lines), 2)
+        for raw, compressed in lines:
+            self.assertEqual(raw, '1000')
+            self.assertTrue(0 < int(compressed) < 1000)
+
+
+class LogsArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = Node(id=1, mac='n/a', cluster=1, roles=['controller'],
+                         os_platform='ubuntu', online=True, status='ready',
+                         ip='127.0.0.1', conf=load_conf(None))
+        self.codec_cmd = tools.codec_cmd
+        # "compressor" printing its own niceness
+        tools.codec_cmd = lambda name, level=None: 'cat > /dev/null; nice'
+
+    def tearDown(self):
+        tools.codec_cmd = self.codec_cmd
+
+    def test_prefix_applies_to_codec(self):
+        for delta in [False, True]:
+            cmd = self.node.logs_archive_cmd(delta=delta)
+            self.assertTrue(cmd.startswith('bash -c '))
+            outs, errs, code = tools.ssh_node('127.0.0.1', command=cmd,
+                                              input='{"files": []}',
+                                              prefix='nice -n 19')
+            self.assertEqual(outs.strip(), '19')
+
+
+class ConfIndexTest(unittest.TestCase):
+
+    def conf(self):
+        conf = load_conf(None)
+        conf.update({
+            'cmds': [{'uptime': 'uptime'}],
+            'files': ['/etc/hosts'],
+            'by_roles': {
+                '__default': {'files': ['/etc/resolv.conf']},
+                'controller': {'cmds': [{'ps': 'ps aux'}],
+                               'files': ['/etc/nova']},
+                'compute': {'timeout': 30,
+                            'scripts': ['compute-check'],
+                            'logs': [{'path': '/var/log/nova'}],
+                            'by_os_platform': {
+                                'centos': {'timeout': 40,
+                                           'cmds': [{'rpm': 'rpm -qa'}]}}},
+                'ceph-osd': {'scripts': ['ceph-check']}},
+            'by_os_platform': {'ubuntu': {'cmds': [{'dpkg': 'dpkg -l'}]}},
+            'by_id': {'__default': {'cmds': [{'id': 'hostname'}]},
+                      2: {'logs': [{'path': '/var/log/two'}]},
+                      3: {'cmds': [{'three': 'echo 3'}]},
+                      4: {'prefix': 'nice -n 19'}}})
+        return conf
+
+    def nodes(self, conf, index):
+        platforms = ['ubuntu', 'centos']
+        roles = [['controller'], ['compute'], ['compute', 'ceph-osd'],
+                 ['ceph-osd']]
+        return [Node(id=i, mac='n/a', cluster=1, roles=roles[i % 4],
+                     os_platform=platforms[i // 4 % 2], online=True,
+                     status='ready', ip='127.0.0.%s' % (i + 2), conf=conf,
+                     conf_index=index) for i in range(16)]
+
+    def state(self, node):
+        return dict((k, v) for k, v in node.__dict__.items()
+                    if k not in ['logger', 'conf'])
+
+    def test_memoized_equals_plain(self):
+        conf = self.conf()
+        index = ConfIndex(conf)
+        self.assertEqual(index.attrs, set(['roles', 'os_platform']))
+        self.assertEqual(index.ids, set(['__default', 2, 3, 4]))
+        plain = self.nodes(conf, None)
+        memoized = self.nodes(conf, index)
+        # nodes 2, 3 and 4 are singled out by id, the rest share results
+        self.assertLess(len(index.resolved), len(plain))
+        for a, b in zip(plain, memoized):
+            self.assertEqual(self.state(a), self.state(b), a.id)
+        # reapplied conf comes from the memo
+        for a, b in zip(plain, memoized):
+            a.apply_conf(conf)
+            b.apply_conf(conf, index=index)
+            self.assertEqual(self.state(a), self.state(b), a.id)
+        self.assertEqual(memoized[3].cmds[-1], {'three': 'echo 3'})
+        self.assertEqual(memoized[4].prefix, 'nice -n 19')
+        self.assertEqual(memoized[5].timeout, 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
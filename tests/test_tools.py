@@ -0,0 +1,392 @@
+import json
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import closing
+
+from timmy import tools
+
+
+class SshNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.script = os.path.join(self.dir, 'script')
+        with open(self.script, 'w') as f:
+            f.write('echo hello\nexit 3\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def output(self, name):
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    def test_script_capped(self):
+        out = os.path.join(self.dir, 'capped')
+        writer = tools.CappedWriter(out, cap=1024)
+        outs, errs, code = tools.ssh_node('127.0.0.1', filename=self.script,
+                                          outputfile=writer)
+        self.assertEqual(code, 3)
+        self.assertEqual(self.output('capped'), 'hello\n')
+
+    def test_script_streamed(self):
+        out = os.path.join(self.dir, 'streamed')
+        outs, errs, code = tools.ssh_node('127.0.0.1', filename=self.script,
+                                          outputfile=out,
+                                          bucket=tools.TokenBucket())
+        self.assertEqual(code, 3)
+        self.assertEqual(self.output('streamed'), 'hello\n')
+
+
+class LaunchCmdTest(unittest.TestCase):
+
+    def test_timeout(self):
+        start = time.time()
+        outs, errs, code = tools.launch_cmd('sleep 5; echo done', 1)
+        self.assertEqual(code, 124)
+        self.assertEqual(outs, '')
+        self.assertLess(time.time() - start, 4)
+
+    def test_concurrent_pipes_not_inherited(self):
+        # quick commands must not wait for slow ones started alongside
+        def slow():
+            tools.launch_cmd(['sleep', '2'], 10)
+        threads = []
+        start = time.time()
+        for i in range(20):
+            threads.append(threading.Thread(target=slow))
+            threads[-1].start()
+            outs, errs, code = tools.launch_cmd(['echo', 'hi'], 10)
+            self.assertEqual(outs, 'hi\n')
+        elapsed = time.time() - start
+        for t in threads:
+            t.join()
+        self.assertLess(elapsed, 1.5)
+
+
+def _sleep_count(limiter):
+    with limiter.section():
+        running = limiter.count.value
+        time.sleep(0.3)
+    return running
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def tearDown(self):
+        tools.close_pools()
+
+    def test_pool_grows(self):
+        for backend in ['thread', 'process']:
+            limiter = tools.Limiter()
+            # the first phase starts the pool with fewer workers
+            tools.run_batch([tools.RunItem(target=len, args={'obj': ''})],
+                            2, backend=backend)
+            items = [tools.RunItem(target=_sleep_count,
+                                   args={'limiter': limiter})
+                     for i in range(6)]
+            result = tools.run_batch(items, 6, backend=backend)
+            self.assertEqual(max(result), 6, backend)
+
+    def test_pipeline_logs_slots(self):
+        # as Node.run_stages: commands, then logs in fewer slots; nodes
+        # waiting for logs must not keep others from running commands
+        def stages(cmds, logs, started):
+            with cmds.section():
+                started.append(time.time())
+                time.sleep(0.1)
+            with logs.section():
+                time.sleep(0.5)
+        cmds = tools.Limiter(4)
+        logs = tools.Limiter(2)
+        started = []
+        items = [tools.RunItem(target=stages,
+                               args={'cmds': cmds, 'logs': logs,
+                                     'started': started})
+                 for i in range(6)]
+        start = time.time()
+        tools.run_batch(items, 4 + 2, backend='thread', pool_size=4)
+        self.assertLess(max(started) - start, 0.4)
+
+
+class Collect(object):
+
+    def __init__(self):
+        self.data = ''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class BatchDemuxTest(unittest.TestCase):
+
+    def demux(self, boundary, stream, count, chunk):
+        writers = [Collect() for i in range(count)]
+        demux = tools.BatchDemux(boundary, writers)
+        for i in range(0, len(stream), chunk):
+            demux.write(stream[i:i + chunk])
+        demux.close()
+        return [w.data for w in writers], demux.results
+
+    def test_batch_script(self):
+        items = ['echo one; echo two',
+                 'printf "no newline"; echo oops >&2; exit 3',
+                 'echo TIMMY-0123 0 0 0 1 0; echo after']
+        script, boundary = tools.batch_script([(10, i) for i in items])
+        stream, errs, code = tools.launch_cmd(['bash', '-s'], 30,
+                                              input=script)
+        self.assertEqual(code, 0)
+        # chunks splitting headers at every offset, and in one piece
+        for chunk in [1, 2, 7, 64, len(stream)]:
+            outs, results = self.demux(boundary, stream, 3, chunk)
+            self.assertEqual(outs, ['one\ntwo\n', 'no newline',
+                                    'TIMMY-0123 0 0 0 1 0\nafter\n'],
+                             chunk)
+            self.assertEqual([results[i][:2] for i in range(3)],
+                             [('', 0), ('oops\n', 3), ('', 0)], chunk)
+
+    def test_marker_in_output(self):
+        # item output is taken by size, even a copy of its own header
+        boundary = 'TIMMY-test'
+        fake = '%s 1 0 5 4 0\n' % boundary
+        stream = ('motd\n%s 0 0 5 %s 0\n%s' % (boundary, len(fake), fake) +
+                  '%s 1 2 5 4 3\nlasterr' % boundary)
+        for chunk in [1, 3, len(stream)]:
+            outs, results = self.demux(boundary, stream, 2, chunk)
+            self.assertEqual(outs, [fake, 'last'], chunk)
+            self.assertEqual(results, {0: ('', 0, 5), 1: ('err', 2, 5)},
+                             chunk)
+
+    def test_truncated(self):
+        # the session died in the middle of the second item
+        boundary = 'TIMMY-test'
+        stream = ('%s 0 0 5 3 0\nok\n' % boundary +
+                  '%s 1 0 5 10 0\npart' % boundary)
+        outs, results = self.demux(boundary, stream, 2, 4)
+        self.assertEqual(outs, ['ok\n', 'part'])
+        self.assertEqual(list(results), [0])
+
+
+class CappedWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, chunks, **kwargs):
+        path = os.path.join(self.dir, name)
+        writer = tools.CappedWriter(path, **kwargs)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        with open(path) as f:
+            return f.read()
+
+    def test_uncapped(self):
+        self.assertEqual(self.write('out', ['abc', 'def'], tail=4),
+                         'abcdef')
+
+    def test_head_tail(self):
+        data = ''.join(chr(ord('a') + i % 26) for i in range(100))
+        # odd cap - the head gets the extra byte
+        out = self.write('out', [data[i:i + 7] for i in range(0, 100, 7)],
+                         cap=11)
+        self.assertEqual(out, data[:6] + '\n[... 89 bytes skipped ...]\n' +
+                         data[-5:])
+
+    def test_under_cap(self):
+        self.assertEqual(self.write('out', ['0123', '4567'], cap=8),
+                         '01234567')
+
+    def test_budget(self):
+        # budget shared by commands of a node runs out on the second one
+        budget = tools.OutputBudget(10)
+        first = self.write('first', ['x' * 6], cap=8, budget=budget)
+        self.assertEqual(first, 'xxxxxx')
+        second = self.write('second', ['0123456789'], cap=8, budget=budget)
+        self.assertEqual(second, '0123\n[... 6 bytes skipped ...]\n')
+        third = self.write('third', ['abc'], cap=8, budget=budget)
+        self.assertEqual(third, '\n[... 3 bytes skipped ...]\n')
+        self.assertEqual(budget.left.value, 0)
+
+    def test_budget_keeps_tail(self):
+        budget = tools.OutputBudget(6)
+        out = self.write('out', ['0123456789'], cap=8, budget=budget)
+        self.assertEqual(out, '0123\n[... 4 bytes skipped ...]\n89')
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.manifest = {'time': '2016-05-01T10:00:00',
+                         'outputs': {'cmds/node-1/uptime': self.entry('a')}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def entry(self, sha1, code=0):
+        return {'node': 1, 'type': 'cmds', 'sha1': sha1, 'code': code}
+
+    def save(self, manifest, name=tools.run_manifest):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        return path
+
+    def archive(self, name, *members):
+        path = os.path.join(self.dir, name)
+        with closing(tarfile.open(path, 'w:gz')) as tar:
+            for member in members:
+                tar.add(os.path.join(self.dir, member), arcname=member)
+        return path
+
+    def test_load(self):
+        path = self.save(self.manifest)
+        self.assertEqual(tools.manifest_load(path), self.manifest)
+        self.assertEqual(tools.manifest_load(self.dir), self.manifest)
+        archive = self.archive('run.tar.gz', tools.run_manifest)
+        self.assertEqual(tools.manifest_load(archive), self.manifest)
+
+    def test_load_missing(self):
+        self.assertRaises(IOError, tools.manifest_load,
+                          os.path.join(self.dir, 'none'))
+        # outdir and archive of a run without a manifest
+        self.assertRaises(IOError, tools.manifest_load, self.dir)
+        self.save({}, 'other.json')
+        archive = self.archive('old.tar.gz', 'other.json')
+        self.assertRaises(IOError, tools.manifest_load, archive)
+
+    def test_load_not_manifest(self):
+        path = self.save({'time': '2016-05-01T10:00:00'})
+        self.assertRaises(KeyError, tools.manifest_load, path)
+        self.save(['outputs'], 'list.json')
+        self.assertRaises(KeyError, tools.manifest_load,
+                          os.path.join(self.dir, 'list.json'))
+
+    def test_diff(self):
+        old = {'time': 'old',
+               'outputs': {'same': self.entry('a'),
+                           'content': self.entry('b'),
+                           'code': self.entry('c', 0),
+                           'removed': self.entry('d')}}
+        new = {'time': 'new',
+               'outputs': {'same': self.entry('a'),
+                           'content': self.entry('B'),
+                           'code': self.entry('c', 1),
+                           'added': self.entry('e')}}
+        report = tools.manifest_diff(old, new)
+        self.assertEqual((report['base'], report['time']), ('old', 'new'))
+        self.assertEqual(report['added'], {'added': self.entry('e')})
+        self.assertEqual(report['removed'], {'removed': self.entry('d')})
+        self.assertEqual(report['changed'],
+                         {'content': {'old': self.entry('b'),
+                                      'new': self.entry('B')},
+                          'code': {'old': self.entry('c', 0),
+                                   'new': self.entry('c', 1)}})
+        self.assertEqual(report['unchanged'], 1)
+
+    def test_diff_empty_base(self):
+        report = tools.manifest_diff({'outputs': {}}, self.manifest)
+        self.assertEqual(report['base'], None)
+        self.assertEqual(report['added'], self.manifest['outputs'])
+        self.assertEqual((report['changed'], report['removed'],
+                          report['unchanged']), ({}, {}, 0))
+
+
+class LogsDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, 'log')
+        with open(self.log, 'w') as f:
+            f.write('old\nnew\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def delta(self, state, prelude=''):
+        out = os.path.join(self.dir, 'delta.tar')
+        outs, errs, code = tools.launch_cmd(
+            [sys.executable, '-c', prelude + tools.logs_delta], 30,
+            input=json.dumps({'files': [self.log], 'state': state}),
+            outfile=out)
+        self.assertEqual(code, 0, errs)
+        members = {}
+        with closing(tarfile.open(out)) as tar:
+            for member in tar:
+                members[member.name] = tar.extractfile(member).read()
+        manifest = json.loads(members.pop(tools.logs_delta_manifest))
+        return members, manifest[self.log]
+
+    def test_appended(self):
+        st = os.stat(self.log)
+        members, entry = self.delta({self.log: [st.st_ino, 4, 0]})
+        self.assertEqual(members, {self.log.lstrip('/'): 'new\n'})
+        self.assertEqual((entry['offset'], entry['length'], entry['size']),
+                         (4, 4, 8))
+
+    def test_truncated_while_read(self):
+        # the file is 5 bytes longer when stat'ed than when read
+        prelude = ('import os\n'
+                   'stat = os.stat\n'
+                   'os.stat = lambda p: os.stat_result(stat(p)[:6] +'
+                   ' (stat(p).st_size + 5,) + stat(p)[7:])\n')
+        members, entry = self.delta({}, prelude)
+        self.assertEqual(members,
+                         {self.log.lstrip('/'): 'old\nnew\n' + '\0' * 5})
+        self.assertEqual((entry['offset'], entry['length'], entry['size']),
+                         (0, 8, 8))
+
+
+class NodeHealthTest(unittest.TestCase):
+
+    def call(self, errs, code):
+        def f():
+            self.calls += 1
+            return '', errs, code
+        self.calls = 0
+        return f
+
+    def test_connection_failures(self):
+        health = tools.NodeHealth('node 1', retries=2, delay=0,
+                                  failures_max=3)
+        refused = 'ssh: connect to host 10.0.0.1 port 22: Connection refused'
+        health.run(self.call(refused, 255))
+        self.assertEqual(self.calls, 3)
+        self.assertTrue(health.down())
+        outs, errs, code = health.run(self.call('', 0))
+        self.assertEqual((self.calls, code), (0, 255))
+        self.assertEqual(health.skipped.value, 1)
+
+    def test_command_exit_255(self):
+        health = tools.NodeHealth('node 1', retries=2, delay=0,
+                                  failures_max=1)
+        health.run(self.call('some error', 255))
+        self.assertEqual(self.calls, 1)
+        self.assertFalse(health.down())
+
+    def test_local_node(self):
+        health = tools.NodeHealth('node 0', retries=2, delay=0,
+                                  failures_max=1)
+        outs, errs, code = tools.ssh_node(
+            '127.0.0.1', command='echo run; echo Connection refused >&2;'
+            ' exit 255', health=health)
+        self.assertEqual((outs, code), ('run\n', 255))
+        self.assertFalse(health.down())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+#    Copyright 2015 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmark of NodeManager phases in a simulated Fuel environment: a local
+Nailgun/Keystone stand-in serves N nodes with loopback addresses (which run
+commands locally, without ssh) and logs are collected from a generated
+log tree. Usage: python -m timmy.bench -n 10 100 1000 -o report.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import threading
+import time
+import yaml
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from tempfile import mkdtemp
+from timmy.conf import load_conf
+from timmy.env import version
+from timmy.nodes import ConfIndex, NodeManager
+from timmy import tools
+
+phases = ['init', 'apply_conf_cold', 'apply_conf_warm', 'run_commands',
+          'create_archive_general', 'calculate_log_size', 'get_logs']
+
+rq = {'cmds': {'__default': [{'uptime': 'uptime'},
+                             {'loadavg': 'cat /proc/loadavg'}],
+               'by_roles': {'controller': [{'env': 'env | sort'}],
+                            'compute': [{'mounts': 'cat /proc/mounts'}]}},
+      'scripts': {'__default': ['bench-script'],
+                  'by_release': {'9.0': {'by_roles': {
+                      'controller': ['bench-script-controller']}}}}}
+
+scripts = {'bench-script': 'ls -l /etc | head -n 50\n',
+           'bench-script-controller': 'ps aux | head -n 50\nexit 0\n'}
+
+log_dirs = ['', 'nova', 'neutron', 'keystone', 'glance', 'cinder', 'ceph']
+log_words = ['nova', 'compute', 'instance', 'request', 'neutron', 'port',
+             'binding', 'failed', 'succeeded', 'agent', 'heartbeat', 'rpc',
+             'timeout', 'volume', 'attach', 'image', 'token', 'validated']
+log_levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR']
+
+
+def loopback_ip(i):
+    '''Address of the i-th node, 127.0.0.1 is the Fuel node'''
+    i += 2
+    return '127.%s.%s.%s' % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+def make_nodes(count):
+    '''Returns /api/nodes data of count ready nodes in one cluster'''
+    roles = [['controller'], ['compute'], ['compute'], ['ceph-osd']]
+    return [{'id': i + 1,
+             'cluster': 1,
+             'roles': roles[i % len(roles)],
+             'mac': '52:54:00:%02x:%02x:%02x' % ((i >> 16) & 255,
+                                                 (i >> 8) & 255, i & 255),
+             'os_platform': 'ubuntu',
+             'status': 'ready',
+             'online': True,
+             'ip': loopback_ip(i)} for i in range(count)]
+
+
+def make_logs(path, files=30, size=65536, seed=0):
+    '''Generates a /var/log like tree of files of about size bytes'''
+    rnd = random.Random(seed)
+    for i in range(files):
+        d = os.path.join(path, log_dirs[i % len(log_dirs)])
+        tools.mdir(d)
+        name = os.path.join(d, 'bench-%s.log' % i)
+        t = 1460000000
+        with open(name, 'w') as f:
+            written = 0
+            while written < size:
+                t += rnd.randint(0, 5)
+                line = '%s %s %s [req-%08x] %s\n' % (
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)),
+                    rnd.getrandbits(16), rnd.choice(log_levels),
+                    rnd.getrandbits(32),
+                    ' '.join(rnd.choice(log_words) for w in range(8)))
+                f.write(line)
+                written += len(line)
+        # rotated logs are excluded by the default filter
+        if i % 5 == 0:
+            shutil.copy(name, name + '-20160101')
+
+
+def make_rq(path):
+    '''Writes rq.yaml and scripts, returns (rqdir, rqfile)'''
+    rqdir = os.path.join(path, 'rq')
+    tools.mdir(os.path.join(rqdir, 'scripts'))
+    for name, code in scripts.items():
+        with open(os.path.join(rqdir, 'scripts', name), 'w') as f:
+            f.write(code)
+    rqfile = os.path.join(path, 'rq.yaml')
+    with open(rqfile, 'w') as f:
+        yaml.dump(rq, f)
+    return rqdir, rqfile
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeNailgun(object):
+    '''
+    Nailgun and Keystone stand-in serving nodes, clusters and version of
+    a simulated environment on a free local port
+    '''
+
+    def __init__(self, nodes, release='9.0'):
+        data = {'/api/nodes': nodes,
+                '/api/clusters': [{'id': 1, 'fuel_version': release}],
+                '/api/version': {'release': release}}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def send(self, code, body='', headers=None):
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.getheader('Content-Length') or 0)
+                self.rfile.read(length)
+                self.send(201, '{}', {'X-Subject-Token': 'bench'})
+
+            def do_GET(self):
+                if self.path in data:
+                    self.send(200, json.dumps(data[self.path]))
+                else:
+                    self.send(404)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_conf(workdir, port, logdir, backend):
+    conf = load_conf(None)
+    conf['rqdir'], conf['rqfile'] = make_rq(workdir)
+    conf.update({'fuel_ip': '127.0.0.1',
+                 'nailgun_port': str(port),
+                 'keystone_port': str(port),
+                 'prefix': '',
+                 'ssh_mux': False,
+                 'run_backend': backend,
+                 'inventory_ttl': 0,
+                 'cache_dir': os.path.join(workdir, 'cache'),
+                 'outdir': os.path.join(workdir, 'info'),
+                 'archive_dir': os.path.join(workdir, 'archives'),
+                 'logs': {'path': logdir,
+                          'exclude': r'[-_]\d{8}$|atop[-_]|\.gz$'},
+                 'logs_free_soft': 0,
+                 'logs_free_hard': 0})
+    return conf
+
+
+def timed(times, phase, f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    times[phase] = round(time.time() - start, 4)
+    return result
+
+
+def reapply_conf_cold(nm):
+    '''nodes_reapply_conf with a fresh ConfIndex - nothing memoized yet'''
+    nm.conf_index = ConfIndex(nm.conf)
+    nm.nodes_reapply_conf()
+
+
+def bench(count, workdir, logdir, backend='thread', maxthreads=100,
+          logs_maxthreads=100, timeout=15):
+    '''Runs all phases for count nodes, returns {phase: seconds}'''
+    server = FakeNailgun(make_nodes(count)).start()
+    try:
+        conf = bench_conf(workdir, server.port, logdir, backend)
+        times = {}
+        nm = timed(times, 'init', NodeManager, conf)
+        timed(times, 'apply_conf_cold', reapply_conf_cold, nm)
+        timed(times, 'apply_conf_warm', nm.nodes_reapply_conf)
+        nm.archive_start()
+        timed(times, 'run_commands', nm.run_commands, timeout=timeout,
+              maxthreads=maxthreads)
+        timed(times, 'create_archive_general', nm.create_archive_general,
+              timeout=conf['compress_timeout'])
+        timed(times, 'calculate_log_size', nm.calculate_log_size,
+              timeout=timeout, maxthreads=maxthreads)
+        timed(times, 'get_logs', nm.get_logs, conf['compress_timeout'],
+              maxthreads=logs_maxthreads)
+    finally:
+        tools.close_pools()
+        server.stop()
+    times['total'] = round(sum(times.values()), 4)
+    return times
+
+
+def compare(base, report, threshold=None):
+    '''
+    Prints phase times of report against base, returns phases (as
+    "<nodes>/<phase>") slower by more than threshold percent
+    '''
+    slower = []
+    base_results = dict((r['nodes'], r['times']) for r in base['results'])
+    print('%6s %-24s %10s %10s %8s' % ('nodes', 'phase', 'base, s',
+                                       'new, s', 'change'))
+    for result in report['results']:
+        old = base_results.get(result['nodes'])
+        if old is None:
+            continue
+        for phase in phases + ['total']:
+            if phase not in old or phase not in result['times']:
+                continue
+            a, b = old[phase], result['times'][phase]
+            change = (b - a) * 100.0 / a if a else 0
+            print('%6s %-24s %10.3f %10.3f %+7.1f%%' %
+                  (result['nodes'], phase, a, b, change))
+            if threshold is not None and change > threshold:
+                slower.append('%s/%s' % (result['nodes'], phase))
+    return slower
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--nodes', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help='Numbers of simulated nodes to benchmark.')
+    parser.add_argument('-b', '--backend', default='thread',
+                        choices=tools.run_backends,
+                        help='run_backend to use.')
+    parser.add_argument('-m', '--maxthreads', type=int, default=100,
+                        help='Maximum simultaneous nodes for commands.')
+    parser.add_argument('-L', '--logs-maxthreads', type=int, default=100,
+                        help='Maximum simultaneous nodes for logs.')
+    parser.add_argument('--log-files', type=int, default=30,
+                        help='Number of generated log files.')
+    parser.add_argument('--log-size', type=int, default=65536,
+                        help='Size of every generated log file, bytes.')
+    parser.add_argument('-o', '--output',
+                        help='Write the report (json) to this file.')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='Compare results with a previous report.')
+    parser.add_argument('--threshold', type=float,
+                        help=('With --compare, exit with code 1 if a phase'
+                              ' is slower by more than this percent.'))
+    parser.add_argument('-d', '--workdir',
+                        help=('Directory for generated data and results,'
+                              ' a temporary one is used and removed by'
+                              ' default.'))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='-v for INFO, -vv for DEBUG logging.')
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = parse_args().parse_args(argv[1:])
+    loglevels = [logging.WARNING, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=loglevels[min(len(loglevels) - 1,
+                                            args.verbose)],
+                        format=('%(asctime)s %(levelname)s: %(module)s: '
+                                '%(funcName)s(): %(message)s'))
+    workdir = args.workdir or mkdtemp(prefix='timmy-bench-')
+    logdir = os.path.join(workdir, 'log')
+    make_logs(logdir, args.log_files, args.log_size)
+    report = {'version': version,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'backend': args.backend,
+              'maxthreads': args.maxthreads,
+              'logs_maxthreads': args.logs_maxthreads,
+              'log_files': args.log_files,
+              'log_size': args.log_size,
+              'results': []}
+    try:
+        for count in args.nodes:
+            times = bench(count, os.path.join(workdir, 'nodes-%s' % count),
+                          logdir, args.backend, args.maxthreads,
+                          args.logs_maxthreads)
+            report['results'].append({'nodes': count, 'times': times})
+            print('%s nodes: %s' % (count, ', '.join(
+                '%s %.3fs' % (p, times[p]) for p in phases + ['total'])))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        slower = compare(tools.load_json_file(args.compare), report,
+                         args.threshold)
+        if slower:
+            print('Slower than %s%%: %s' % (args.threshold,
+                                            ', '.join(slower)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -21,19 +21,33 @@ import logging
 import sys
 import os
 from timmy.conf import load_conf
-from timmy.tools import interrupt_wrapper
+from timmy import tools
+from timmy.tools import interrupt_wrapper, close_pools
 
 
 def pretty_run(quiet, msg, f, args=[], kwargs={}):
     if not quiet:
         sys.stdout.write('%s...\r' % msg)
         sys.stdout.flush()
-    result = f(*args, **kwargs)
+    with tools.trace_span(msg, 'phase', 'timmy'):
+        result = f(*args, **kwargs)
     if not quiet:
         print('%s: done' % msg)
     return result
 
 
+def codec_benchmark(path, level=None):
+    results = tools.codec_benchmark(path, level=level)
+    if not results:
+        print('No data to compress in %s' % path)
+        return 1
+    print('Sample: %s bytes from %s' % (results[0][4], path))
+    print('%-6s %5s %7s %9s' % ('codec', 'level', 'ratio', 'MB/s'))
+    for name, level, ratio, speed, size in results:
+        print('%-6s %5s %7.2f %9.1f' % (name, level, ratio, speed))
+    return 0
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description=('Parallel remote command'
                                                   ' execution and file'
@@ -44,6 +58,13 @@ def parse_args():
                         help=('Path to a json file retrieved via'
                               ' "fuel node --json". Useful to speed up'
                               ' initialization, skips "fuel node" call.'))
+    parser.add_argument('--refresh-inventory', action='store_true',
+                        help=('Ignore cached node list and releases, query'
+                              ' Nailgun and update the cache.'))
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help=('Run commands and scripts even if their output'
+                              ' is in the result cache (see cache_ttl) and'
+                              ' update the cache.'))
     parser.add_argument('-o', '--dest-file',
                         help=('Output filename for the archive in tar.gz'
                               ' format for command outputs and collected'
@@ -80,10 +101,53 @@ def parse_args():
                               ' Each argument must contain two strings -'
                               ' source file/path/mask and dest. file/path.'
                               ' For help on shell mode, read timmy/conf.py.'))
+    parser.add_argument('-B', '--batch-exec', action='store_true',
+                        help=('Run all commands and scripts of a node in a'
+                              ' single remote session instead of one ssh'
+                              ' call per command or script.'))
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('Let every node go through upload, commands,'
+                              ' files, logs size and logs on its own instead'
+                              ' of waiting for all nodes to finish each'
+                              ' phase. -m, -L, bandwidth and free space'
+                              ' limits still apply.'))
+    parser.add_argument('--adaptive-concurrency', action='store_true',
+                        help=('Adapt the number of simultaneous nodes of'
+                              ' every phase (up to -m / -L) to ssh failures,'
+                              ' timeouts, latency and local load.'))
     parser.add_argument('-l', '--logs',
                         help=('Collect logs from nodes. Logs are not collected'
                               ' by default due to their size.'),
                         action='store_true', dest='getlogs')
+    parser.add_argument('--logs-incremental', action='store_true',
+                        help=('Only collect log data appended since the last'
+                              ' successful collection, whole files if rotated'
+                              ' or truncated. Result is placed into'
+                              ' logs-node-<id>-delta.tar.gz archives.'
+                              ' Requires --no-clean - archives of earlier'
+                              ' runs hold the only copy of data collected'
+                              ' before.'))
+    parser.add_argument('-Z', '--compression',
+                        help=('Compression for log and general archives:'
+                              ' gzip, pigz, zstd or lz4. Nodes where it is'
+                              ' not installed fall back to gzip.'))
+    parser.add_argument('--compression-level', type=int,
+                        help='Codec specific compression level.')
+    parser.add_argument('--codec-benchmark', nargs='?', const='/var/log',
+                        metavar='PATH',
+                        help=('Compress a sample of local files under PATH'
+                              ' (default /var/log) with every installed'
+                              ' codec, print compression ratio and speed,'
+                              ' then exit.'))
+    parser.add_argument('--diff-against', metavar='RUN',
+                        help=('Compare outputs and files with a previous run'
+                              ' - its outdir, archive or manifest.json. The'
+                              ' archive then only contains new and changed'
+                              ' outputs and a changes.json report.'))
+    parser.add_argument('--trace', metavar='FILE',
+                        help=('Write a timeline of run phases and of every'
+                              ' remote call (node, command, bytes, queue'
+                              ' delay) to FILE in Chrome trace format.'))
     parser.add_argument('--fuel-ip', help='fuel ip address')
     parser.add_argument('--fuel-user', help='fuel username')
     parser.add_argument('--fuel-pass', help='fuel password')
@@ -165,6 +229,37 @@ def main(argv=None):
         conf['shell_mode'] = True
     if args.no_clean:
         conf['clean'] = False
+    if args.refresh_inventory:
+        conf['inventory_refresh'] = True
+    if args.refresh_cache:
+        conf['cache_refresh'] = True
+    if args.logs_incremental:
+        conf['logs_incremental'] = True
+    if args.batch_exec:
+        conf['batch_exec'] = True
+    if args.pipeline:
+        conf['pipeline'] = True
+    if args.adaptive_concurrency:
+        conf['concurrency_adaptive'] = True
+    if args.compression:
+        conf['compression'] = args.compression
+    if args.compression_level:
+        conf['compression_level'] = args.compression_level
+    if args.diff_against:
+        conf['diff_against'] = args.diff_against
+    if args.trace:
+        conf['trace_file'] = args.trace
+    if (conf['logs_incremental'] and conf['clean'] and
+            (args.getlogs or args.only_logs)):
+        logger.critical('incremental log collection requires --no-clean:'
+                        ' cleaning %s would delete the only copy of log data'
+                        ' collected by earlier runs' % conf['archive_dir'])
+        sys.exit(1)
+    if args.codec_benchmark:
+        return codec_benchmark(args.codec_benchmark,
+                               conf['compression_level'])
+    if not args.quiet and sys.stdout.isatty():
+        conf['progress'] = True
     if conf['shell_mode']:
         filter = conf['hard_filter']
         # config cleanup for shell mode
@@ -200,40 +295,85 @@ def main(argv=None):
     if args.dest_file:
         conf['archive_dir'] = os.path.split(args.dest_file)[0]
         conf['archive_name'] = os.path.split(args.dest_file)[1]
+    if conf['trace_file']:
+        tools.trace_start(conf['trace_file'])
     logger.info('Using rqdir: %s, rqfile: %s' %
                 (conf['rqdir'], conf['rqfile']))
     nm = pretty_run(args.quiet, 'Initializing node data',
                     NodeManager,
                     kwargs={'conf': conf, 'extended': args.extended,
                             'nodes_json': args.nodes_json})
-    if not args.only_logs:
-        if nm.has(Node.pkey):
-            pretty_run(args.quiet, 'Uploading files', nm.put_files)
-        if nm.has(Node.ckey, Node.skey):
-            pretty_run(args.quiet, 'Executing commands and scripts',
-                       nm.run_commands, args=(args.maxthreads,))
-        if nm.has(Node.fkey, Node.flkey):
-            pretty_run(args.quiet, 'Collecting files and filelists',
-                       nm.get_files, args=(args.maxthreads,))
-        if not args.no_archive and nm.has(*Node.conf_archive_general):
-            pretty_run(args.quiet, 'Creating outputs and files archive',
-                       nm.create_archive_general, args=(60,))
-    if args.only_logs or args.getlogs:
-        size = pretty_run(args.quiet, 'Calculating logs size',
-                          nm.calculate_log_size, args=(args.maxthreads,))
-        if size == 0:
-            logger.warning('Size zero - no logs to collect.')
-            return
-        enough = pretty_run(args.quiet, 'Checking free space',
-                            nm.is_enough_space)
-        if enough:
-            pretty_run(args.quiet, 'Collecting and packing logs', nm.get_logs,
-                       args=(conf['compress_timeout'],),
-                       kwargs={'maxthreads': args.logs_maxthreads,
-                               'fake': args.fake_logs})
-        else:
-            logger.warning(('Not enough space for logs in "%s", skipping'
-                            'log collection.') % nm.conf['archive_dir'])
+    if conf['ssh_mux']:
+        pretty_run(args.quiet, 'Opening ssh connections', nm.ssh_mux_start,
+                   args=(args.maxthreads,))
+    try:
+        if not args.only_logs:
+            if not args.no_archive and nm.has(*Node.conf_archive_general):
+                nm.archive_start()
+        if conf['pipeline']:
+            stages = []
+            if not args.only_logs:
+                for stage, keys in [('put', [Node.pkey]),
+                                    ('cmds', [Node.ckey, Node.skey]),
+                                    ('files', [Node.fkey, Node.flkey])]:
+                    if nm.has(*keys):
+                        stages.append(stage)
+            if args.only_logs or args.getlogs:
+                stages.append('logs')
+            pretty_run(args.quiet, 'Running nodes', nm.run_pipeline,
+                       args=(stages,),
+                       kwargs={'maxthreads': args.maxthreads,
+                               'logs_maxthreads': args.logs_maxthreads,
+                               'logs_timeout': conf['compress_timeout'],
+                               'fake_logs': args.fake_logs})
+        elif not args.only_logs:
+            # scp/rsync fan-out keeps its limit of 10 nodes unless adaptive
+            # concurrency is there to back it off
+            transfers = {}
+            if conf['concurrency_adaptive']:
+                transfers = {'maxthreads': args.maxthreads}
+            if nm.has(Node.pkey):
+                pretty_run(args.quiet, 'Uploading files', nm.put_files,
+                           kwargs=transfers)
+            if nm.has(Node.ckey, Node.skey):
+                pretty_run(args.quiet, 'Executing commands and scripts',
+                           nm.run_commands,
+                           kwargs={'maxthreads': args.maxthreads})
+            if nm.has(Node.fkey, Node.flkey):
+                pretty_run(args.quiet, 'Collecting files and filelists',
+                           nm.get_files, kwargs=transfers)
+        if not args.only_logs:
+            if nm.has(*Node.conf_archive_general):
+                pretty_run(args.quiet, 'Writing run manifest',
+                           nm.manifest_save)
+            if not args.no_archive and nm.has(*Node.conf_archive_general):
+                pretty_run(args.quiet, 'Finishing outputs and files archive',
+                           nm.create_archive_general, args=(60,))
+        if (args.only_logs or args.getlogs) and not conf['pipeline']:
+            size = pretty_run(args.quiet, 'Calculating logs size',
+                              nm.calculate_log_size,
+                              kwargs={'maxthreads': args.maxthreads})
+            if size == 0:
+                logger.warning('Size zero - no logs to collect.')
+                return
+            enough = pretty_run(args.quiet, 'Checking free space',
+                                nm.is_enough_space)
+            if enough:
+                pretty_run(args.quiet, 'Collecting and packing logs',
+                           nm.get_logs, args=(conf['compress_timeout'],),
+                           kwargs={'maxthreads': args.logs_maxthreads,
+                                   'fake': args.fake_logs})
+            else:
+                logger.warning(('Not enough space for logs in "%s", skipping'
+                                'log collection.') % nm.conf['archive_dir'])
+    finally:
+        nm.ssh_mux_stop()
+        close_pools()
+        if conf['trace_file']:
+            count = tools.trace_export(conf['trace_file'])
+            logger.info('%s spans written to %s' % (count,
+                                                    conf['trace_file']))
+    nm.health_report()
     logger.info("Nodes:\n%s" % nm)
     if not args.quiet:
         print('Run complete. Node information:')
@@ -245,6 +385,25 @@ def main(argv=None):
             for node in nm.sorted_nodes():
                 node.print_results(node.mapcmds)
                 node.print_results(node.mapscr)
+    skipped = nm.nodes_skipped()
+    if skipped:
+        print('Nodes found down, their remaining operations were skipped: %s'
+              % ', '.join(str(n.id) for n in skipped))
+    failed = nm.nodes_failed()
+    if failed:
+        print('Nodes failed with errors (see log): %s' %
+              ', '.join(str(n.id) for n, errors in failed))
+    if nm.logs_incomplete:
+        print('Logs were not collected because of low disk space in "%s"'
+              ' from nodes: %s' % (nm.conf['archive_dir'],
+                                   ', '.join(str(n.id) for n in
+                                             sorted(nm.logs_incomplete,
+                                                    key=lambda n: n.id))))
+    if nm.changes is not None and not args.quiet:
+        print('Changes since %s: %s added, %s changed, %s removed, see "%s".'
+              % (nm.changes['base'], len(nm.changes['added']),
+                 len(nm.changes['changed']), len(nm.changes['removed']),
+                 os.path.join(nm.conf['outdir'], tools.run_changes)))
     if nm.has(Node.ckey, Node.skey, Node.fkey, Node.flkey) and not args.quiet:
         print('Outputs and/or files available in "%s".' % nm.conf['outdir'])
     if all([not args.no_archive, nm.has(*Node.conf_archive_general),
@@ -20,6 +20,49 @@ def load_conf(filename):
     conf['fuel_pass'] = 'admin'
     conf['timeout'] = 15
     conf['prefix'] = 'nice -n 19 ionice -c 3'
+    '''Reuse one multiplexed ssh connection (ControlMaster) per node for all
+    ssh, scp and rsync calls during a run.'''
+    conf['ssh_mux'] = True
+    conf['ssh_mux_dir'] = os.path.join(gettempdir(), 'timmy', 'ssh')
+    conf['ssh_mux_persist'] = 600
+    '''ssh, scp and rsync calls which fail to connect (ssh connection error
+    in stderr, local nodes are not tracked) are retried ssh_retries times,
+    after ssh_retry_delay seconds doubled on every attempt. After
+    ssh_failures_max failed connections in a row the node is considered
+    down and the rest of its calls are skipped.'''
+    conf['ssh_retries'] = 2
+    conf['ssh_retry_delay'] = 1
+    conf['ssh_failures_max'] = 3
+    '''Run all cmds and scripts of a node in a single remote session.'''
+    conf['batch_exec'] = False
+    '''Every node goes through put, cmds, files, logs size and logs on its
+    own instead of all nodes finishing each phase before the next starts.
+    Concurrency (maxthreads), bandwidth and free space limits still apply,
+    free space is checked per node against its projected logs size.'''
+    conf['pipeline'] = False
+    '''Adapt the number of nodes processed at once (up to maxthreads) to
+    how remote calls go, separately for every phase: start with
+    concurrency_start, grow while calls succeed, halve (not below
+    concurrency_min) on ssh failures (code 255), timeouts (code 124),
+    calls getting concurrency_latency_factor times slower than the best
+    seen (not for logs - bandwidth is shared) or local load average per
+    CPU above concurrency_max_load.'''
+    conf['concurrency_adaptive'] = False
+    conf['concurrency_start'] = 10
+    conf['concurrency_min'] = 2
+    conf['concurrency_latency_factor'] = 3
+    conf['concurrency_max_load'] = 2.0
+    '''How run_batch runs nodes in parallel: "fork" - new process per node,
+    "thread" or "process" - long-lived pool of run_pool_size workers, reused
+    by all phases of a run. The pool has at least maxthreads workers of the
+    phase - it is replaced by a bigger one when a phase needs more.
+    "gevent" - all nodes in one process on the gevent event loop, for
+    thousands of concurrent nodes.'''
+    conf['run_backend'] = 'thread'
+    conf['run_pool_size'] = None
+    '''Show a live progress line (nodes done/total, rate, slowest nodes)
+    while nodes are being processed.'''
+    conf['progress'] = False
     rqdir = 'rq'
     rqfile = 'rq.yaml'
     dtm = os.path.join(os.path.abspath(os.sep), 'usr', 'share', 'timmy')
@@ -32,6 +75,19 @@ def load_conf(filename):
     else:
         conf['rqfile'] = rqfile
     conf['compress_timeout'] = 3600
+    '''Cache of Nailgun node list and cluster releases, per fuel_ip.
+    inventory_ttl - seconds the cache is used, 0 disables caching.
+    inventory_refresh - ignore the cache and query Nailgun.'''
+    conf['cache_dir'] = os.path.join(gettempdir(), 'timmy', 'cache')
+    conf['inventory_ttl'] = 300
+    conf['inventory_refresh'] = False
+    '''Seconds the output of a command or script (by name) is reused from
+    the local result cache in cache_dir instead of running it again, i.e.
+    {'cpuinfo': 86400} - usually set in rqfile, can be set per role, release
+    etc. An entry is run again when its code or env_vars change.
+    cache_refresh - run everything and refresh the cache.'''
+    conf['cache_ttl'] = {}
+    conf['cache_refresh'] = False
     conf['outdir'] = os.path.join(gettempdir(), 'timmy', 'info')
     conf['archive_dir'] = os.path.join(gettempdir(), 'timmy', 'archives')
     conf['archive_name'] = 'general.tar.gz'
@@ -44,6 +100,47 @@ def load_conf(filename):
     conf['filelists'] = []
     conf['logs'] = {'path': '/var/log',
                     'exclude': '[-_]\d{8}$|atop[-_]|\.gz$'}
+    '''Incremental log collection - only fetch data appended since the last
+    successful collection (state is kept in cache_dir) into
+    logs-node-<id>-delta.tar.gz archives. Requires clean = False, archives
+    of earlier runs hold the only copy of data collected before.'''
+    conf['logs_incremental'] = False
+    '''Share of the admin interface speed used for log collection. All
+    nodes share this bandwidth, nodes which finish early give it back.'''
+    conf['logs_speed_ratio'] = 0.9
+    '''Compression of log and general archives: gzip, pigz (parallel gzip),
+    zstd or lz4. Nodes where the codec is not installed fall back to gzip.
+    compression_level - codec specific, None means codec default.'''
+    conf['compression'] = 'gzip'
+    conf['compression_level'] = None
+    '''Free space check uses the size of compressed log archives projected
+    from compressing this many largest files of every log class on each
+    node. 0 - use raw log size.'''
+    conf['logs_sample_files'] = 3
+    '''Free space watermarks (percent) of archive_dir filesystem during log
+    collection: below soft no new node is started, below hard the largest
+    running transfers are stopped. 0 - disabled.'''
+    conf['logs_free_soft'] = 10
+    conf['logs_free_hard'] = 5
+    '''Size limits (bytes) for outputs of commands and scripts: for each
+    output and for all outputs of a run. Truncated outputs keep their
+    beginning and end. 0 - no limit.'''
+    conf['cmd_output_cap'] = 0
+    conf['outputs_total_cap'] = 0
+    '''Keep every distinct command/script output once in outdir/.store,
+    outputs being hard links to it - outputs of nodes and of runs kept with
+    --no-clean and -t which did not change take no extra space, also in
+    the general archive.'''
+    conf['outputs_store'] = False
+    '''Run manifest (a manifest.json file, an outdir or an archive of a run)
+    to compare outputs of this run against - only outputs which are new or
+    changed get into the general archive, named <name>-delta.tar.gz,
+    along with the change report changes.json'''
+    conf['diff_against'] = None
+    '''File to write a Chrome trace format timeline of the run to - spans of
+    run phases, Nailgun requests, per node tasks with their queue delay and
+    of every remote call with bytes in/out and exit code'''
+    conf['trace_file'] = None
     '''Shell mode - only run what was specified via command line.
     Skip actionable conf fields (see timmy/nodes.py -> Node.conf_actionable);
     Skip rqfile import;
@@ -24,12 +24,48 @@ import os
 import shutil
 import logging
 import sys
-import re
+import time
+import tarfile
+from contextlib import closing
 from datetime import datetime
+from pipes import quote
 import tools
-from tools import auth_token, w_list, run_with_lock
+from tools import w_list, run_with_lock
 from copy import deepcopy
-import urllib2
+
+
+class ConfIndex(object):
+    '''
+    Attributes and node ids which Node.apply_conf results depend on, found
+    once in conf, and apply_conf results memoized by node signature.
+    '''
+
+    def __init__(self, conf):
+        self.attrs = set()
+        self.ids = set()
+        self.resolved = {}
+        self.compile(conf)
+
+    def compile(self, el):
+        if type(el) is not dict:
+            return
+        p = Node.conf_match_prefix
+        for k, v in el.items():
+            if k == Node.conf_priority_section and type(v) is dict:
+                self.ids.update(v)
+            elif type(k) is str and k.startswith(p):
+                self.attrs.add(k[len(p):])
+            self.compile(v)
+
+    def signature(self, node):
+        sig = []
+        for attr in sorted(self.attrs):
+            if hasattr(node, attr):
+                sig.append(tuple(w_list(getattr(node, attr))))
+            else:
+                sig.append(None)
+        sig.append(node.id if node.id in self.ids else None)
+        return tuple(sig)
 
 
 class Node(object):
@@ -51,7 +87,7 @@ class Node(object):
     print_template += ' {6:<6} {7}'
 
     def __init__(self, id, mac, cluster, roles, os_platform,
-                 online, status, ip, conf, logger=None):
+                 online, status, ip, conf, logger=None, conf_index=None):
         self.id = id
         self.mac = mac
         self.cluster = cluster
@@ -71,13 +107,30 @@ class Node(object):
         self.logsize = 0
         self.mapcmds = {}
         self.mapscr = {}
+        # exit codes of commands and scripts by output file
+        self.codes = {}
+        self.cache_hits = {}
         self.filtered_out = False
+        self.logs_rate = None
+        self.logs_ratios = {}
         self.outputs_timestamp = False
         self.outputs_timestamp_dir = None
-        self.apply_conf(conf)
+        self.mux = None
+        # tools.NodeHealth, set by NodeManager
+        self.health = None
+        self.apply_conf(conf, index=conf_index)
         self.conf = conf
         self.logger = logger or logging.getLogger(__name__)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('logger', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(__name__)
+
     def __str__(self):
         if not self.filtered_out:
             my_id = self.id
@@ -88,20 +141,33 @@ class Node(object):
                          self.os_platform, ','.join(self.roles),
                          str(self.online), self.status)
 
-    def apply_conf(self, conf, clean=True):
+    def apply_conf(self, conf, clean=True, index=None):
+        '''
+        Sets node attributes from conf. With clean=True and a ConfIndex of
+        conf, the result is computed once per node signature and shared
+        by all nodes with the same signature - so node attributes set here
+        must never be modified in place, only replaced.
+        '''
+
+        def get(k):
+            return res[k] if k in res else getattr(self, k)
+
+        def has(k):
+            return k in res or hasattr(self, k)
 
         def apply(k, v, c_a, k_d, o, default=False):
             if k in c_a:
                 if any([default,
                         k not in k_d and k not in o,
-                        not hasattr(self, k)]):
-                    setattr(self, k, deepcopy(w_list(v)))
+                        not has(k)]):
+                    res[k] = deepcopy(w_list(v))
                 else:
-                    getattr(self, k).extend(deepcopy(w_list(v)))
+                    # copy on write - the old list may be shared
+                    res[k] = get(k) + deepcopy(w_list(v))
                 if not default:
                     o[k] = True
             else:
-                setattr(self, k, deepcopy(v))
+                res[k] = deepcopy(v)
 
         def r_apply(el, p, p_s, c_a, k_d, o, d, clean=False):
             # apply normal attributes
@@ -113,8 +179,8 @@ class Node(object):
             # apply match attributes (by_xxx except by_id)
             for k in [k for k in el if k != p_s and k.startswith(p)]:
                 attr_name = k[len(p):]
-                if hasattr(self, attr_name):
-                    attr = w_list(getattr(self, attr_name))
+                if has(attr_name):
+                    attr = w_list(get(attr_name))
                     for v in attr:
                         if v in el[k]:
                             subconf = el[k][v]
@@ -140,50 +206,40 @@ class Node(object):
         k_d = Node.conf_keep_default
         d = Node.conf_default_key
         overridden = {}
+        res = {}
+        signature = None
+        if clean and index is not None:
+            signature = index.signature(self)
+            if signature in index.resolved:
+                self.__dict__.update(index.resolved[signature])
+                return
         if clean:
             '''clean appendable keep_default params to ensure no content
             duplication if this function gets called more than once'''
             for f in set(c_a).intersection(k_d):
-                setattr(self, f, [])
+                res[f] = []
         r_apply(conf, p, p_s, c_a, k_d, overridden, d, clean=clean)
+        if signature is not None:
+            index.resolved[signature] = res
+        self.__dict__.update(res)
 
-    def get_release(self):
-        token = auth_token(self.conf)
-        if not self.cluster:
-            req = urllib2.Request("http://" + self.conf['fuel_ip'] + ":"
-                                  + self.conf['nailgun_port'] + "/api/version",
-                                  None, {'X-Auth-Token': token})
-        else:
-            req = urllib2.Request("http://" + self.conf['fuel_ip'] + ":"
-                                  + self.conf['nailgun_port']
-                                  + "/api/clusters",
-                                  None, {'X-Auth-Token': token})
-
-        if urllib2.urlopen(req).getcode() != 200:
-            self.logger.warning('node: %s: could not determine'
-                                ' MOS release' % self.id)
-
-        data = urllib2.urlopen(req).read()
-
-        if not self.cluster:
-            release = json.loads(data).get('release')
-            self.release = release
-
-        for key in json.loads(data):
-            if self.cluster and key.get('id') == self.cluster:
-                release = key.get('fuel_version')
-                self.release = release
-        return release
-
-    def exec_cmd(self, fake=False, ok_codes=None):
-        sn = 'node-%s' % self.id
-        cl = 'cluster-%s' % self.cluster
-        self.logger.debug('%s/%s/%s/%s' % (self.outdir, Node.ckey, cl, sn))
-        ddir = os.path.join(self.outdir, Node.ckey, cl, sn)
+    def output_dir(self, key):
+        return os.path.join(self.outdir, key, 'cluster-%s' % self.cluster,
+                            'node-%s' % self.id)
+
+    def exec_cmd(self, fake=False, ok_codes=None, budget=None):
+        ddir = self.output_dir(Node.ckey)
+        self.logger.debug(ddir)
         if self.cmds:
             tools.mdir(ddir)
         self.cmds = sorted(self.cmds)
         mapcmds = {}
+        codes = {}
+        # whether outputs were served from the result cache, by dfile
+        hits = {}
+        # (name, cache key, dfile) of cacheable outputs to be run
+        misses = []
+        batch = []
         for c in self.cmds:
             for cmd in c:
                 dfile = os.path.join(ddir, 'node-%s-%s-%s' %
@@ -192,20 +248,32 @@ class Node(object):
                         dfile += self.outputs_timestamp_str
                 self.logger.info('outfile: %s' % dfile)
                 mapcmds[cmd] = dfile
-                if not fake:
-                    outs, errs, code = tools.ssh_node(ip=self.ip,
-                                                      command=c[cmd],
-                                                      ssh_opts=self.ssh_opts,
-                                                      env_vars=self.env_vars,
-                                                      timeout=self.timeout,
-                                                      prefix=self.prefix)
-                    self.check_code(code, 'exec_cmd', c[cmd], ok_codes)
-                    try:
-                        with open(dfile, 'w') as df:
-                            df.write(outs.encode('utf-8'))
-                    except:
-                        self.logger.error("can't write to file %s" %
-                                          dfile)
+                if fake:
+                    continue
+                key = self.cache_key(cmd, command=c[cmd])
+                hits[dfile] = self.cache_serve(cmd, key, dfile, budget)
+                if hits[dfile]:
+                    codes[dfile] = 0
+                    continue
+                if key:
+                    misses.append((cmd, key, dfile))
+                if self.batch_exec:
+                    batch.append((c[cmd], c[cmd], dfile))
+                    continue
+                with self.trace(cmd, bytes_in=len(c[cmd])) as span:
+                    outs, errs, code = tools.ssh_node(
+                        ip=self.ip,
+                        command=c[cmd],
+                        ssh_opts=self.ssh_opts,
+                        env_vars=self.env_vars,
+                        timeout=self.timeout,
+                        prefix=self.prefix,
+                        mux=self.mux,
+                        health=self.health,
+                        outputfile=self.output_writer(dfile, budget))
+                    span.update(code=code, bytes_out=self.file_size(dfile))
+                codes[dfile] = code
+                self.check_code(code, 'exec_cmd', c[cmd], ok_codes)
         if self.scripts:
             tools.mdir(ddir)
         self.scripts = sorted(self.scripts)
@@ -219,49 +287,279 @@ class Node(object):
                     dfile += self.outputs_timestamp_str
             self.logger.info('outfile: %s' % dfile)
             mapscr[scr] = dfile
-            if not fake:
-                outs, errs, code = tools.ssh_node(ip=self.ip,
-                                                  filename=f,
-                                                  ssh_opts=self.ssh_opts,
-                                                  env_vars=self.env_vars,
-                                                  timeout=self.timeout,
-                                                  prefix=self.prefix)
-                self.check_code(code, 'exec_cmd', 'script %s' % f, ok_codes)
+            if fake:
+                continue
+            key = self.cache_key(scr, script=f)
+            hits[dfile] = self.cache_serve(scr, key, dfile, budget)
+            if hits[dfile]:
+                codes[dfile] = 0
+                continue
+            if key:
+                misses.append((scr, key, dfile))
+            if self.batch_exec:
                 try:
-                    with open(dfile, 'w') as df:
-                        df.write(outs.encode('utf-8'))
-                except:
-                    self.logger.error("can't write to file %s" % dfile)
-        return mapcmds, mapscr
+                    with open(f, 'r') as sf:
+                        batch.append(('script %s' % f, sf.read(), dfile))
+                except IOError:
+                    self.logger.error('could not read file: %s' % f)
+                continue
+            with self.trace(scr, bytes_in=self.file_size(f)) as span:
+                outs, errs, code = tools.ssh_node(
+                    ip=self.ip,
+                    filename=f,
+                    ssh_opts=self.ssh_opts,
+                    env_vars=self.env_vars,
+                    timeout=self.timeout,
+                    prefix=self.prefix,
+                    mux=self.mux,
+                    health=self.health,
+                    outputfile=self.output_writer(dfile, budget))
+                span.update(code=code, bytes_out=self.file_size(dfile))
+            codes[dfile] = code
+            self.check_code(code, 'exec_cmd', 'script %s' % f, ok_codes)
+        if batch:
+            codes.update(self.exec_batch(batch, ok_codes, budget))
+        for name, key, dfile in misses:
+            if codes.get(dfile) == 0:
+                self.result_cache().put(key, dfile, name=name, code=0)
+        return mapcmds, mapscr, codes, hits
 
-    def exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
-                        fake=False, ok_codes=None, input=None):
-        self.logger.info('node:%s(%s), exec: %s' % (self.id, self.ip, cmd))
-        if not fake:
+    def result_cache(self):
+        return tools.ResultCache(os.path.join(self.cache_dir, 'results',
+                                              self.fuel_ip,
+                                              'node-%s' % self.id))
+
+    def cache_key(self, name, command=None, script=None):
+        '''
+        Returns the result cache key of a command or a script (file) by its
+        name, content and environment, None if name is not to be cached
+        '''
+        if not self.cache_ttl or not self.cache_ttl.get(name):
+            return None
+        if script is not None:
+            try:
+                command = tools.file_sha1(script)
+            except IOError:
+                return None
+        return tools.ResultCache.key(self.id, name, command, self.env_vars,
+                                     self.prefix)
+
+    def cache_serve(self, name, key, dfile, budget=None):
+        '''Writes the cached output of name to dfile, returns True if hit'''
+        if key is None or self.cache_refresh:
+            return False
+        hit = self.result_cache().get(key, self.cache_ttl[name])
+        if hit is None:
+            return False
+        self.logger.info('node: %s, %s: cached output of %s' %
+                         (self.id, name, datetime.fromtimestamp(
+                             hit[1]['time']).strftime('%F %T')))
+        out = self.output_writer(dfile, budget, True)
+        with open(hit[0], 'rb') as f:
+            for data in iter(lambda: f.read(1048576), ''):
+                out.write(data)
+        out.close()
+        return True
+
+    def exec_batch(self, batch, ok_codes=None, budget=None):
+        '''
+        Runs (name, code, dfile) items in a single remote session, returns
+        exit codes of items by dfile
+        '''
+        script, boundary = tools.batch_script([(self.timeout, i[1])
+                                               for i in batch])
+        timeout = self.timeout * (len(batch) + 1)
+        self.logger.info('node:%s(%s), exec batch of %s items' %
+                         (self.id, self.ip, len(batch)))
+        demux = tools.BatchDemux(boundary,
+                                 [self.output_writer(dfile, budget, True)
+                                  for name, code, dfile in batch])
+        with self.trace('batch', bytes_in=len(script), items=len(batch)) as s:
+            start = time.time()
             outs, errs, code = tools.ssh_node(ip=self.ip,
-                                              command=cmd,
+                                              command='bash -s',
                                               ssh_opts=self.ssh_opts,
                                               env_vars=self.env_vars,
                                               timeout=timeout,
-                                              outputfile=outfile,
-                                              ok_codes=ok_codes,
-                                              input=input,
-                                              prefix=self.prefix)
+                                              input=script,
+                                              prefix=self.prefix,
+                                              mux=self.mux,
+                                              health=self.health,
+                                              outputfile=demux)
+            s.update(code=code, bytes_out=sum(self.file_size(i[2])
+                                              for i in batch))
+        self.check_code(code, 'exec_batch', 'batch', ok_codes)
+        codes = {}
+        for idx, (name, item_code, dfile) in enumerate(batch):
+            if idx not in demux.results:
+                self.logger.error('node: %s, ip: %s, no result for %s in'
+                                  ' batch' % (self.id, self.ip, name))
+                continue
+            i_errs, i_code, duration = demux.results[idx]
+            # items run one by one, spans are laid out from the batch start
+            end = start + duration / 1000.0
+            tools.trace_event(name, 'remote', 'node-%s' % self.id, start, end,
+                              {'node': self.id, 'ip': self.ip, 'code': i_code,
+                               'bytes_in': len(item_code),
+                               'bytes_out': self.file_size(dfile)})
+            start = end
+            self.logger.debug('node: %s, cmd: %s, code: %s, duration: %s ms,'
+                              ' stderr: %s' % (self.id, name, i_code,
+                                               duration, i_errs))
+            codes[dfile] = i_code
+            self.check_code(i_code, 'exec_cmd', name, ok_codes)
+        return codes
+
+    def output_writer(self, dfile, budget=None, writer=False):
+        '''
+        Returns where to write output of a command: dfile itself, or a
+        writer capping its size and storing it in the output store
+        '''
+        store = None
+        if self.outputs_store:
+            store = tools.OutputStore(os.path.join(self.outdir,
+                                                   tools.OutputStore.dirname))
+        if not any([self.cmd_output_cap, budget, store, writer]):
+            return dfile
+        return tools.CappedWriter(dfile, self.cmd_output_cap, budget,
+                                  store=store)
+
+    def exec_simple_cmd(self, cmd, timeout=15, infile=None, outfile=None,
+                        fake=False, ok_codes=None, input=None, bucket=None,
+                        monitor=None, name=None):
+        self.logger.info('node:%s(%s), exec: %s' % (self.id, self.ip, cmd))
+        if not fake:
+            with self.trace(name or cmd, bytes_in=len(input or '')) as span:
+                outs, errs, code = tools.ssh_node(ip=self.ip,
+                                                  command=cmd,
+                                                  ssh_opts=self.ssh_opts,
+                                                  env_vars=self.env_vars,
+                                                  timeout=timeout,
+                                                  outputfile=outfile,
+                                                  ok_codes=ok_codes,
+                                                  input=input,
+                                                  prefix=self.prefix,
+                                                  mux=self.mux,
+                                                  health=self.health,
+                                                  bucket=bucket,
+                                                  monitor=monitor)
+                span.update(code=code, bytes_out=self.file_size(outfile)
+                            if outfile else len(outs))
             self.check_code(code, 'exec_simple_cmd', cmd, ok_codes)
+            return code
+
+    def trace(self, name, **args):
+        '''Span of a remote call on the node track, see tools.trace_span'''
+        return tools.trace_span(name, 'remote', 'node-%s' % self.id,
+                                node=self.id, ip=self.ip, **args)
+
+    def logs_state_file(self):
+        return os.path.join(self.cache_dir, 'logs-state', self.fuel_ip,
+                            'node-%s.json' % self.id)
+
+    def get_logs_archive(self, outfile, timeout, bucket=None, monitor=None):
+        '''
+        Collects log files into outfile, returns (code, bytes, seconds)
+        '''
+        input = ''
+        for fn in self.logs_dict():
+            input += '%s\0' % fn.lstrip(os.path.abspath(os.sep))
+        cmd = self.logs_archive_cmd()
+        start = time.time()
+        code = self.exec_simple_cmd(cmd, timeout=timeout, outfile=outfile,
+                                    input=input, ok_codes=[0, 1],
+                                    bucket=bucket, monitor=monitor,
+                                    name='logs archive')
+        return code, self.file_size(outfile), time.time() - start
+
+    def logs_archive_cmd(self, delta=False):
+        '''
+        Returns a command writing the compressed logs archive (tar of files
+        listed on stdin, or with delta the logs_delta script) to stdout. It
+        is a single "bash -c" so that prefix applies to the compressor too.
+        '''
+        if delta:
+            producer = 'python -c %s' % quote(tools.logs_delta)
+        else:
+            producer = ('tar -C %s --create --warning=no-file-changed'
+                        ' --file - --null --files-from -' %
+                        os.path.abspath(os.sep))
+        codec = tools.codec_cmd(self.compression, self.compression_level)
+        return 'bash -c %s' % quote('%s | %s%s' % (producer, codec,
+                                                   tools.pipe_exit))
+
+    def get_logs_delta(self, outfile, timeout, bucket=None, monitor=None):
+        '''
+        Collects only data appended to log files since the last successful
+        collection (whole files if rotated or truncated) into outfile.
+        A file's tar member holds its bytes starting from "offset", recorded
+        with new size, inode and mtime in the manifest member of the archive.
+        Returns (code, bytes, seconds).
+        '''
+        state_file = self.logs_state_file()
+        try:
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            state = {}
+        input = json.dumps({'files': sorted(self.logs_dict()),
+                            'state': state})
+        cmd = self.logs_archive_cmd(delta=True)
+        start = time.time()
+        code = self.exec_simple_cmd(cmd, timeout=timeout, outfile=outfile,
+                                    input=input, ok_codes=[0], bucket=bucket,
+                                    monitor=monitor, name='logs delta')
+        result = code, self.file_size(outfile), time.time() - start
+        if code != 0:
+            return result
+        manifest = None
+        try:
+            with tools.codec_open(outfile) as f:
+                with closing(tarfile.open(fileobj=f, mode='r|')) as tar:
+                    for member in tar:
+                        if member.name == tools.logs_delta_manifest:
+                            manifest = json.loads(tar.extractfile(
+                                member).read())
+            if manifest is None:
+                raise KeyError(tools.logs_delta_manifest)
+        except (IOError, KeyError, ValueError, tarfile.TarError) as e:
+            self.logger.error('node: %s, bad delta archive %s: %s' %
+                              (self.id, outfile, e))
+            return (1,) + result[1:]
+        state = dict((f, [m['inode'], m['size'], m['mtime']])
+                     for f, m in manifest.items())
+        tools.mdir(os.path.dirname(state_file))
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(state_file + '.tmp', state_file)
+        self.logger.info('node: %s, delta: %s bytes in %s files' %
+                         (self.id, sum(m['length'] for m in
+                                       manifest.values()),
+                          len([m for m in manifest.values()
+                               if m['length']])))
+        return result
+
+    def file_size(self, fname):
+        try:
+            return os.path.getsize(fname)
+        except OSError:
+            return 0
 
     def get_files(self, timeout=15):
         self.logger.info('node: %s, IP: %s' % (self.id, self.ip))
-        sn = 'node-%s' % self.id
-        cl = 'cluster-%s' % self.cluster
         if self.files or self.filelists:
-            ddir = os.path.join(self.outdir, Node.fkey, cl, sn)
+            ddir = self.output_dir(Node.fkey)
             tools.mdir(ddir)
         if self.shell_mode:
             for f in self.files:
-                outs, errs, code = tools.get_file_scp(ip=self.ip,
-                                                      file=f,
-                                                      ddir=ddir,
-                                                      recursive=True)
+                with self.trace('scp %s' % f) as span:
+                    outs, errs, code = tools.get_file_scp(ip=self.ip,
+                                                          file=f,
+                                                          ddir=ddir,
+                                                          recursive=True,
+                                                          mux=self.mux,
+                                                          health=self.health)
+                    span['code'] = code
                 self.check_code(code, 'get_files', 'tools.get_file_scp')
         else:
             data = ''
@@ -277,58 +575,160 @@ class Node(object):
             data += '\n'.join(self.files)
             self.logger.debug('node: %s, data:\n%s' % (self.id, data))
             if data:
-                o, e, c = tools.get_files_rsync(ip=self.ip,
-                                                data=data,
-                                                ssh_opts=self.ssh_opts,
-                                                dpath=ddir,
-                                                timeout=self.timeout)
+                with self.trace('rsync', bytes_in=len(data)) as span:
+                    o, e, c = tools.get_files_rsync(ip=self.ip,
+                                                    data=data,
+                                                    ssh_opts=self.ssh_opts,
+                                                    dpath=ddir,
+                                                    timeout=self.timeout,
+                                                    mux=self.mux,
+                                                    health=self.health)
+                    span['code'] = c
                 self.check_code(c, 'get_files', 'tools.get_files_rsync')
 
     def put_files(self):
         self.logger.info('node: %s, IP: %s' % (self.id, self.ip))
         for f in self.put:
-            outs, errs, code = tools.put_file_scp(ip=self.ip,
-                                                  file=f[0],
-                                                  dest=f[1],
-                                                  recursive=True)
+            with self.trace('put %s' % f[0]) as span:
+                outs, errs, code = tools.put_file_scp(ip=self.ip,
+                                                      file=f[0],
+                                                      dest=f[1],
+                                                      recursive=True,
+                                                      mux=self.mux,
+                                                      health=self.health)
+                span['code'] = code
 
     def logs_populate(self, timeout=5):
+        '''
+        Finds log files of all logs items in a single remote call, filters
+        are applied on the node. Sets "files" ({file: size}) and "mtimes"
+        ({file: mtime}) of every item.
+        '''
+        # items may be shared with other nodes, see apply_conf
+        self.logs = [dict(item) for item in self.logs]
+        if not self.logs:
+            return self.logs
+        items = [dict((k, item.get(k)) for k in
+                      ['path', 'include', 'exclude', 'start'])
+                 for item in self.logs]
+        cmd = 'python -c %s' % quote(tools.logs_inventory)
+        self.logger.info('node: %s, logs inventory: %s' % (self.id, items))
+        input = json.dumps({'items': items})
+        with self.trace('logs inventory', bytes_in=len(input)) as span:
+            outs, errs, code = tools.ssh_node(ip=self.ip,
+                                              command=cmd,
+                                              ssh_opts=self.ssh_opts,
+                                              env_vars='',
+                                              timeout=timeout,
+                                              prefix=self.prefix,
+                                              input=input,
+                                              mux=self.mux,
+                                              health=self.health)
+            span.update(code=code, bytes_out=len(outs))
+        if code != 0:
+            self.logger.error("node: %s, ip: %s, logs inventory failed, "
+                              "code: %s, error message: %s" %
+                              (self.id, self.ip, code, errs))
+            return self.logs
+        try:
+            listing = json.loads(outs)
+        except ValueError:
+            self.logger.error('node: %s, bad logs inventory: %s' %
+                              (self.id, outs[:200]))
+            return self.logs
+        for item in self.logs:
+            item['files'] = {}
+            item['mtimes'] = {}
+        for d, files in listing.items():
+            for name, size, mtime, mask in files:
+                f = os.path.join(d, name)
+                for n, item in enumerate(self.logs):
+                    if mask & 1 << n:
+                        item['files'][f] = size
+                        item['mtimes'][f] = mtime
+        self.logger.debug('logs: %s' % self.logs)
+        return self.logs
 
-        def filter_by_re(item, string):
-            return (('include' not in item or
-                     re.search(item['include'], string)) and
-                    ('exclude' not in item or not
-                     re.search(item['exclude'], string)))
+    def logs_classes(self):
+        '''
+        Returns {file: class}, class being the first logs item the file
+        belongs to and whether the file is compressed already
+        '''
+        classes = {}
+        for n, item in enumerate(self.logs):
+            for f in item.get('files', {}):
+                if f not in classes:
+                    classes[f] = (n, tools.is_compressed(f))
+        return classes
 
-        for item in self.logs:
-            if 'start' in item:
-                start = ' -newermt \\"$(date -d \'%s\')\\"' % item['start']
-            else:
-                start = ''
-            cmd = ("find '%s' -type f%s -exec du -b {} +" % (item['path'],
-                                                             start))
-            self.logger.info('node: %s, logs du-cmd: %s' %
-                             (self.id, cmd))
+    def logs_sample(self, timeout=15, files=3, size=1048576):
+        '''
+        Compresses the first size bytes of up to files largest files of
+        every log class on the node with the configured codec. Returns
+        {class: ratio}, the worst (highest) ratio found for every class.
+        '''
+        sizes = self.logs_dict()
+        by_class = {}
+        for f, c in self.logs_classes().items():
+            by_class.setdefault(c, []).append(f)
+        sample = []
+        for c, fnames in by_class.items():
+            fnames = sorted(fnames, key=lambda f: sizes[f], reverse=True)
+            sample += [(c, f) for f in fnames[:files] if sizes[f]]
+        if not sample:
+            return {}
+        cmd = self.logs_sample_cmd([f for c, f in sample], size)
+        with self.trace('logs sample', bytes_in=len(cmd)) as span:
             outs, errs, code = tools.ssh_node(ip=self.ip,
                                               command=cmd,
                                               ssh_opts=self.ssh_opts,
                                               env_vars='',
                                               timeout=timeout,
-                                              prefix=self.prefix)
-            if code == 124:
-                self.logger.error("node: %s, ip: %s, command: %s, "
-                                  "timeout code: %s, error message: %s" %
-                                  (self.id, self.ip, cmd, code, errs))
-                break
-            if len(outs):
-                item['files'] = {}
-                for line in outs.split('\n'):
-                    if '\t' in line:
-                        size, f = line.split('\t')
-                        if filter_by_re(item, f):
-                            item['files'][f] = int(size)
-                self.logger.debug('logs: %s' % (item['files']))
-        return self.logs
+                                              prefix=self.prefix,
+                                              mux=self.mux,
+                                              health=self.health)
+            span.update(code=code, bytes_out=len(outs))
+        ratios = {}
+        for (c, f), line in zip(sample, outs.splitlines()):
+            try:
+                raw, compressed = [int(x) for x in line.split()]
+            except ValueError:
+                continue
+            if raw:
+                ratios[c] = max(ratios.get(c, 0), float(compressed) / raw)
+        self.logger.debug('node: %s, compression ratios: %s' %
+                          (self.id, ratios))
+        return ratios
+
+    def logs_sample_cmd(self, fnames, size):
+        '''
+        Returns a command printing raw and compressed size of the first size
+        bytes of every file, a line per file. It is a single "bash -c" so
+        that prefix applies to all of it.
+        '''
+        codec = tools.codec_cmd(self.compression, self.compression_level)
+        script = '; '.join(['echo $(head -c %s %s | wc -c)'
+                            ' $(head -c %s %s | %s | wc -c)' %
+                            (size, quote(f), size, quote(f), codec)
+                            for f in fnames])
+        return 'bash -c %s' % quote(script)
+
+    def logs_scan(self, timeout=15):
+        '''Returns (logs, compression ratios), see logs_sample'''
+        self.logs_populate(timeout)
+        ratios = {}
+        if self.logs_sample_files:
+            ratios = self.logs_sample(timeout, files=self.logs_sample_files)
+        return self.logs, ratios
+
+    def logs_estimate(self):
+        '''
+        Returns projected compressed size of logs. Classes which were not
+        sampled are assumed to be incompressible.
+        '''
+        classes = self.logs_classes()
+        return sum(int(s * min(self.logs_ratios.get(classes[f], 1), 1))
+                   for f, s in self.logs_dict().items())
 
     def logs_dict(self):
         result = {}
@@ -341,7 +741,50 @@ class Node(object):
                         result[f] = s
         return result
 
+    def run_stages(self, stages, cmds_limit, logs_limit, budget=None,
+                   logs=None):
+        '''
+        Runs stages ("put", "cmds", "files", "logs") of the node one after
+        another, within cmds_limit (Limiter) and, for log collection, within
+        logs_limit reserving the projected archive size of disk space.
+        logs - args of get_logs_archive / get_logs_delta, with "space"
+        (path, coefficient) to check free space of.
+        Returns results by stage, "logs" is (code, bytes, seconds).
+        '''
+        result = {}
+        with cmds_limit.section():
+            if 'put' in stages:
+                self.put_files()
+            if 'cmds' in stages:
+                result['cmds'] = self.exec_cmd(budget=budget)
+            if 'files' in stages:
+                self.get_files()
+                result['files'] = True
+            if 'logs' in stages:
+                result['scan'] = self.logs_scan(self.timeout)
+        if 'logs' not in stages or not logs or not self.logs_dict():
+            return result
+        args = dict(logs)
+        path, coefficient = args.pop('space')
+        reserve = self.logs_estimate() * coefficient
+        if not logs_limit.acquire(reserve, lambda: tools.free_bytes(path)):
+            self.logger.error('node: %s, not enough space in %s for logs,'
+                              ' %d bytes needed' % (self.id, path, reserve))
+            result['logs'] = (tools.DiskMonitor.aborted, 0, 0)
+            return result
+        try:
+            if self.logs_incremental:
+                result['logs'] = self.get_logs_delta(**args)
+            else:
+                result['logs'] = self.get_logs_archive(**args)
+        finally:
+            logs_limit.release(reserve)
+        return result
+
     def check_code(self, code, func_name, cmd, ok_codes=None):
+        if code and self.health and self.health.down():
+            # reported once by health
+            return
         if code:
             if not ok_codes or code not in ok_codes:
                 self.logger.warning("%s: got bad exit code %s,"
@@ -351,6 +794,9 @@ class Node(object):
     def print_results(self, result_map):
         # result_map should be either mapcmds or mapscr
         for cmd in sorted(result_map):
+            if not os.path.exists(result_map[cmd]):
+                # skipped, node is down
+                continue
             with open(result_map[cmd], 'r') as f:
                 for line in f.readlines():
                     print('node-%s:\t%s' %
@@ -360,6 +806,10 @@ class Node(object):
 class NodeManager(object):
     """Class nodes """
 
+    # run_batch phases with their own concurrency limit, "nodes" - node
+    # stages of the pipeline but logs
+    phases = ['ssh_mux', 'put', 'cmds', 'files', 'logs_size', 'logs', 'nodes']
+
     def __init__(self, conf, extended=False, nodes_json=None, logger=None):
         self.conf = conf
         self.logger = logger or logging.getLogger(__name__)
@@ -370,9 +820,33 @@ class NodeManager(object):
             if conf['dir_timestamp']:
                 conf['outdir'] += timestamp_str
                 conf['archive_dir'] += timestamp_str
+        self.diff_base = None
+        if conf['diff_against']:
+            # before cleaning - might be the manifest of the last run
+            try:
+                self.diff_base = tools.manifest_load(conf['diff_against'])
+            except (IOError, OSError, KeyError, ValueError,
+                    tarfile.TarError) as e:
+                self.logger.critical('NodeManager: cannot load run manifest'
+                                     ' from %s: %s' % (conf['diff_against'],
+                                                       e))
+                sys.exit(1)
         if conf['clean']:
             shutil.rmtree(conf['outdir'], ignore_errors=True)
             shutil.rmtree(conf['archive_dir'], ignore_errors=True)
+        elif conf['outputs_store']:
+            store = tools.OutputStore(os.path.join(
+                conf['outdir'], tools.OutputStore.dirname))
+            self.logger.info('output store: %s bytes of unused blobs removed'
+                             % store.gc())
+        if conf['run_backend'] not in tools.run_backends:
+            self.logger.critical('NodeManager: unknown run_backend %s' %
+                                 conf['run_backend'])
+            sys.exit(1)
+        err = tools.codec_check(conf['compression'], conf['compression_level'])
+        if err:
+            self.logger.critical('NodeManager: %s' % err)
+            sys.exit(1)
         if not conf['shell_mode']:
             self.rqdir = conf['rqdir']
             if (not os.path.exists(self.rqdir)):
@@ -382,11 +856,42 @@ class NodeManager(object):
             if self.conf['rqfile']:
                 self.import_rq()
         self.nodes = {}
+        self.bucket = tools.TokenBucket()
+        self.disk_monitor = tools.DiskMonitor()
+        self.output_budget = None
+        if conf['outputs_total_cap']:
+            self.output_budget = tools.OutputBudget(
+                conf['outputs_total_cap'])
+        self.logs_incomplete = []
+        # errors of nodes which failed in run_batch, by node key
+        self.failed = {}
+        self.limits = {}
+        if conf['concurrency_adaptive']:
+            for phase in self.phases:
+                self.limits[phase] = tools.AdaptiveLimiter(
+                    phase, conf['concurrency_start'], conf['concurrency_min'],
+                    latency=phase != 'logs',
+                    latency_factor=conf['concurrency_latency_factor'],
+                    max_load=conf['concurrency_max_load'])
+        self.cmds_limit = self.limits.get('nodes') or tools.Limiter()
+        self.logs_limit = self.limits.get('logs') or tools.Limiter()
+        self.archive = None
+        self.manifest = None
+        self.changes = None
+        self.api = tools.NailgunClient(self.conf, timeout=self.conf['timeout'])
+        self.conf_index = ConfIndex(self.conf)
         self.fuel_init()
+        self.inventory = None
         if nodes_json:
             self.nodes_json = tools.load_json_file(nodes_json)
         else:
-            self.nodes_json = json.loads(self.get_nodes_json())
+            self.inventory = self.inventory_load()
+            if self.inventory:
+                self.nodes_json = self.inventory['nodes']
+            else:
+                self.nodes_json = json.loads(self.get_nodes_json())
+                self.inventory = {'nodes': self.nodes_json, 'releases': {}}
+                self.inventory_save()
         self.nodes_init()
         # apply soft-filter on all nodes
         for node in self.nodes.values():
@@ -402,6 +907,12 @@ class NodeManager(object):
                 do additional apply_conf(clean=False) with this yaml.
                 Move some stuff from rq.yaml to extended.yaml'''
                 pass
+        for node in self.nodes.values():
+            node.health = tools.NodeHealth('node %s' % node.id,
+                                           node.ssh_retries,
+                                           node.ssh_retry_delay,
+                                           node.ssh_failures_max)
+        self.api.close()
 
     def __str__(self):
         pt = Node.print_template
@@ -477,23 +988,19 @@ class NodeManager(object):
                         status='ready',
                         online=True,
                         ip=self.conf['fuel_ip'],
-                        conf=self.conf)
+                        conf=self.conf,
+                        conf_index=self.conf_index)
         # soft-skip Fuel if it is hard-filtered
         if not self.filter(fuelnode, self.conf['hard_filter']):
             fuelnode.filtered_out = True
         self.nodes[self.conf['fuel_ip']] = fuelnode
 
     def get_nodes_json(self):
-        token = auth_token(self.conf)
-        req = urllib2.Request("http://" + self.conf['fuel_ip']
-                              + ":" + self.conf['nailgun_port'] + "/api/nodes",
-                              None, {'X-Auth-Token': token})
-        if urllib2.urlopen(req).getcode() != 200:
+        status, nodes_json = self.api.get('/api/nodes')
+        if status != 200:
             logging.error('NodeManager get_nodes: cannot get '
                           'fuel node list ')
             sys.exit(4)
-        else:
-            nodes_json = urllib2.urlopen(req).read()
         return nodes_json
 
     def nodes_init(self):
@@ -509,46 +1016,107 @@ class NodeManager(object):
             params = {'id': int(node_data['id']),
                       'cluster': int(node_data['cluster']),
                       'roles': roles,
-                      'conf': self.conf}
+                      'conf': self.conf,
+                      'conf_index': self.conf_index}
             for key in keys:
                 params[key] = node_data[key]
             node = Node(**params)
             if self.filter(node, self.conf['hard_filter']):
                 self.nodes[node.ip] = node
 
+    def inventory_file(self):
+        return os.path.join(self.conf['cache_dir'],
+                            'inventory-%s.json' % self.conf['fuel_ip'])
+
+    def inventory_load(self):
+        '''Returns cached /api/nodes data and releases if not expired'''
+        if self.conf['inventory_refresh'] or not self.conf['inventory_ttl']:
+            return None
+        fname = self.inventory_file()
+        try:
+            age = time.time() - os.stat(fname).st_mtime
+        except OSError:
+            return None
+        if age > self.conf['inventory_ttl']:
+            self.logger.info('inventory cache %s expired' % fname)
+            return None
+        try:
+            with open(fname, 'r') as f:
+                inventory = json.load(f)
+        except (IOError, ValueError):
+            self.logger.warning('could not read inventory cache %s' % fname)
+            return None
+        # json keys are strings, cluster ids are integers
+        inventory['releases'] = dict((int(k), v) for k, v in
+                                     inventory['releases'].items())
+        self.logger.info('using inventory cache %s, age %ds' % (fname, age))
+        return inventory
+
+    def inventory_save(self, keep_mtime=False):
+        if not self.conf['inventory_ttl'] or self.inventory is None:
+            return
+        fname = self.inventory_file()
+        tools.mdir(self.conf['cache_dir'])
+        mtime = None
+        if keep_mtime and os.path.exists(fname):
+            mtime = os.stat(fname).st_mtime
+        try:
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(self.inventory, f)
+            os.rename(fname + '.tmp', fname)
+            if mtime:
+                os.utime(fname, (time.time(), mtime))
+        except (IOError, OSError) as e:
+            self.logger.warning('could not write inventory cache %s: %s' %
+                                (fname, e))
+
     def nodes_get_release(self):
-        known_clusters = {}
-        for key, node in self.nodes.items():
-            if not node.filtered_out and not node.release:
-                if node.cluster not in known_clusters:
-                    self.nodes[key].release = node.get_release()
-                    known_clusters[node.cluster] = node.release
+        '''Sets release of all nodes from a single clusters API response'''
+        releases = {}
+        if self.inventory:
+            releases.update(self.inventory['releases'])
+        for node in self.nodes.values():
+            if node.filtered_out or node.release:
+                continue
+            if node.cluster not in releases:
+                if node.cluster:
+                    for c in self.api.get_json('/api/clusters') or []:
+                        releases[c.get('id')] = c.get('fuel_version')
+                    releases.setdefault(node.cluster, None)
                 else:
-                    self.nodes[key].release = known_clusters.get(node.cluster)
+                    version = self.api.get_json('/api/version') or {}
+                    releases[node.cluster] = version.get('release')
+            node.release = releases.get(node.cluster)
+            if not node.release:
+                self.logger.warning('node: %s: could not determine'
+                                    ' MOS release' % node.id)
+        if self.inventory and releases != self.inventory['releases']:
+            self.inventory['releases'] = releases
+            # releases do not extend the lifetime of the cached node list
+            self.inventory_save(keep_mtime=True)
 
     def conf_assign_once(self):
         once = Node.conf_once_prefix
         p = Node.conf_match_prefix
         once_p = once + p
+        # attribute value -> first node having it, per attribute
+        first = {}
         for k in [k for k in self.conf if k.startswith(once)]:
             attr_name = k[len(once_p):]
-            assigned = dict((k, None) for k in self.conf[k])
-            for ak in assigned:
+            if attr_name not in first:
+                first[attr_name] = {}
                 for node in self.nodes.values():
-                    if hasattr(node, attr_name) and not assigned[ak]:
-                        attr = w_list(getattr(node, attr_name))
-                        for v in attr:
-                            if v == ak:
-                                once_conf = self.conf[k][ak]
-                                node.apply_conf(once_conf, clean=False)
-                                assigned[ak] = node.id
-                                break
-                    if assigned[ak]:
-                        break
+                    if hasattr(node, attr_name):
+                        for v in w_list(getattr(node, attr_name)):
+                            first[attr_name].setdefault(v, node)
+            for ak in self.conf[k]:
+                if ak in first[attr_name]:
+                    node = first[attr_name][ak]
+                    node.apply_conf(self.conf[k][ak], clean=False)
 
     def nodes_reapply_conf(self):
         for node in self.nodes.values():
-            node.apply_conf(self.conf)
+            node.apply_conf(self.conf, index=self.conf_index)
 
     def filter(self, node, node_filter):
         f = node_filter
@@ -564,35 +1132,164 @@ class NodeManager(object):
                 checks.append(not set(node_v).isdisjoint(filter_v))
             return all(checks)
 
+    def run_batch_iter(self, run_items, maxthreads, msg=None, phase=None):
+        '''
+        Yields (key, result) of run_items as nodes finish. With adaptive
+        concurrency at most as many as the limiter of phase allows run.
+        '''
+        limiter = self.phase_limiter(phase, maxthreads)
+        errors = {}
+        for run_item, result in tools.run_batch_iter(
+                self.name_run_items(run_items), maxthreads,
+                backend=self.conf['run_backend'],
+                pool_size=self.conf['run_pool_size'],
+                progress=msg if self.conf['progress'] else None,
+                limiter=limiter, errors=errors):
+            yield run_item.key, result
+        self.add_failed(errors, msg)
+        if limiter:
+            self.logger.info(limiter.summary())
+
+    def run_batch(self, run_items, maxthreads, dict_result=False, msg=None,
+                  phase=None):
+        limiter = self.phase_limiter(phase, maxthreads)
+        errors = {}
+        result = tools.run_batch(self.name_run_items(run_items), maxthreads,
+                                 dict_result=dict_result,
+                                 backend=self.conf['run_backend'],
+                                 pool_size=self.conf['run_pool_size'],
+                                 progress=(msg if self.conf['progress']
+                                           else None),
+                                 limiter=limiter, errors=errors)
+        self.add_failed(errors, msg)
+        if limiter:
+            self.logger.info(limiter.summary())
+        return result
+
+    def add_failed(self, errors, msg):
+        for key, error in errors.items():
+            self.failed.setdefault(key, []).append('%s: %s' % (msg, error))
+
+    def nodes_skipped(self):
+        '''Returns nodes found down, whose remaining calls were skipped'''
+        return [n for n in self.sorted_nodes()
+                if n.health and n.health.down()]
+
+    def nodes_failed(self):
+        '''Returns (node, errors) of nodes which failed in a phase'''
+        return [(n, self.failed[n.ip]) for n in self.sorted_nodes()
+                if n.ip in self.failed]
+
+    def health_report(self):
+        for node in self.nodes_skipped():
+            self.logger.error('node: %s, ip: %s, down - %s remote calls'
+                              ' skipped' % (node.id, node.ip,
+                                            node.health.skipped.value))
+        for node, errors in self.nodes_failed():
+            self.logger.error('node: %s, ip: %s, failed - %s' %
+                              (node.id, node.ip, '; '.join(errors)))
+
+    def phase_limiter(self, phase, maxthreads):
+        limiter = self.limits.get(phase)
+        if limiter:
+            limiter.set_size(maxthreads)
+        return limiter
+
+    def name_run_items(self, run_items):
+        for run_item in run_items:
+            if run_item.name is None and run_item.key in self.nodes:
+                run_item.name = 'node-%s' % self.nodes[run_item.key].id
+        return run_items
+
+    def ssh_mux_start(self, maxthreads=100):
+        '''Opens one multiplexed master ssh connection per node'''
+        ctl_dir = os.path.join(self.conf['ssh_mux_dir'], str(os.getpid()))
+        tools.mdir(ctl_dir)
+        muxes = {}
+        run_items = []
+        for key, node in self.nodes.items():
+            if node.filtered_out or tools.is_local(node.ip):
+                continue
+            mux = tools.SSHMux(ip=node.ip,
+                               ssh_opts=node.ssh_opts,
+                               ctl_dir=ctl_dir,
+                               persist=self.conf['ssh_mux_persist'])
+            muxes[key] = mux
+            run_items.append(tools.RunItem(target=mux.start,
+                                           args={'timeout': node.timeout},
+                                           key=key))
+        result = self.run_batch(run_items, maxthreads, dict_result=True,
+                                msg='Opening ssh connections',
+                                phase='ssh_mux')
+        for key in result:
+            if result[key]:
+                self.nodes[key].mux = muxes[key]
+            else:
+                self.logger.warning('node: %s, could not open master ssh'
+                                    ' connection, using direct ssh' %
+                                    self.nodes[key].id)
+
+    def ssh_mux_stop(self):
+        '''Closes master ssh connections, returns per-node call stats'''
+        stats = {}
+        ctl_dir = None
+        for node in self.sorted_nodes():
+            if not node.mux:
+                continue
+            node.mux.stop(timeout=node.timeout)
+            handshakes, reused = node.mux.stats()
+            stats[node.id] = {'handshakes': handshakes, 'reused': reused}
+            self.logger.info('node: %s, ssh handshakes: %s, reused: %s' %
+                             (node.id, handshakes, reused))
+            ctl_dir = os.path.dirname(node.mux.path)
+            node.mux = None
+        if stats:
+            self.logger.info('ssh total handshakes: %s, reused: %s' %
+                             (sum(s['handshakes'] for s in stats.values()),
+                              sum(s['reused'] for s in stats.values())))
+        if ctl_dir:
+            shutil.rmtree(ctl_dir, ignore_errors=True)
+        return stats
+
     @run_with_lock
     def run_commands(self, timeout=15, fake=False, maxthreads=100):
         run_items = []
         for key, node in self.nodes.items():
             if not node.filtered_out:
-                run_items.append(tools.RunItem(target=node.exec_cmd,
-                                               args={'fake': fake},
-                                               key=key))
-        result = tools.run_batch(run_items, maxthreads, dict_result=True)
-        for key in result:
-            self.nodes[key].mapcmds = result[key][0]
-            self.nodes[key].mapscr = result[key][1]
+                run_items.append(tools.RunItem(
+                    target=node.exec_cmd,
+                    args={'fake': fake, 'budget': self.output_budget},
+                    key=key))
+        for key, result in self.run_batch_iter(
+                run_items, maxthreads, msg='Executing commands and scripts',
+                phase='cmds'):
+            self.nodes[key].mapcmds = result[0]
+            self.nodes[key].mapscr = result[1]
+            self.nodes[key].codes = result[2]
+            self.nodes[key].cache_hits = result[3]
+            self.archive_add(self.nodes[key], Node.ckey)
 
     def calculate_log_size(self, timeout=15, maxthreads=100):
         total_size = 0
+        total_estimate = 0
         run_items = []
         for key, node in self.nodes.items():
             if not node.filtered_out:
-                run_items.append(tools.RunItem(target=node.logs_populate,
+                run_items.append(tools.RunItem(target=node.logs_scan,
                                                args={'timeout': timeout},
                                                key=key))
-        result = tools.run_batch(run_items, maxthreads, dict_result=True)
-        for key in result:
-            self.nodes[key].logs = result[key]
+        for key, result in self.run_batch_iter(run_items, maxthreads,
+                                               msg='Calculating logs size',
+                                               phase='logs_size'):
+            self.nodes[key].logs, self.nodes[key].logs_ratios = result
         for node in self.nodes.values():
             total_size += sum(node.logs_dict().values())
-        self.logger.info('Full log size on nodes(with fuel): %s bytes' %
-                         total_size)
+            total_estimate += node.logs_estimate()
+        self.logger.info('Full log size on nodes(with fuel): %s bytes, '
+                         'estimated archives size: %s bytes' %
+                         (total_size, total_estimate))
         self.alogsize = total_size / 1024
+        self.alogsize_estimate = total_estimate / 1024
         return self.alogsize
 
     def is_enough_space(self, coefficient=1.2):
@@ -607,24 +1304,119 @@ class NodeManager(object):
             self.logger.error("can't get free space\nouts: %s" %
                               outs)
             return False
-        self.logger.info('logsize: %s Kb, free space: %s Kb' %
-                         (self.alogsize, fs))
-        if (self.alogsize*coefficient > fs):
+        self.logger.info('logsize: %s Kb, estimated archives: %s Kb, '
+                         'free space: %s Kb' %
+                         (self.alogsize, self.alogsize_estimate, fs))
+        if (self.alogsize_estimate*coefficient > fs):
             self.logger.error('Not enough space on device')
             return False
         else:
             return True
 
+    def archive_start(self):
+        '''
+        Starts the general archive - outputs of every node are added to it
+        as soon as the node finishes, create_archive_general finalizes it.
+        '''
+        name = self.conf['archive_name']
+        if self.diff_base is not None:
+            # only changed outputs are archived - on finish
+            i = name.find('.tar')
+            i = len(name) if i < 0 else i
+            name = '%s-delta%s' % (name[:i], name[i:])
+        outfile = os.path.join(self.conf['archive_dir'], name)
+        tools.mdir(self.conf['archive_dir'])
+        tools.mdir(self.conf['outdir'])
+        # outputs in the store are archived through their links
+        self.archive = tools.ArchiveWriter(outfile, self.conf['outdir'],
+                                           self.conf['compression'],
+                                           self.conf['compression_level'],
+                                           [tools.OutputStore.dirname])
+
+    def archive_add(self, node, key):
+        if self.archive and self.diff_base is None:
+            self.archive.add(node.output_dir(key))
+
+    def manifest_entries(self, node):
+        outdir = self.conf['outdir']
+        stamp = self.conf.get('outputs_timestamp_str')
+        items = []
+        for key, mapping in [(Node.ckey, node.mapcmds),
+                             (Node.skey, node.mapscr)]:
+            for name, dfile in mapping.items():
+                items.append((key, name, dfile, node.codes.get(dfile)))
+        fdir = node.output_dir(Node.fkey)
+        for root, dirs, files in os.walk(fdir):
+            for f in files:
+                dfile = os.path.join(root, f)
+                items.append((Node.fkey, os.path.relpath(dfile, fdir), dfile,
+                              None))
+        entries = {}
+        for key, name, dfile, code in items:
+            if not os.path.isfile(dfile):
+                continue
+            rel = os.path.relpath(dfile, outdir)
+            # outputs of the same command in runs with -t match
+            path = rel[:-len(stamp)] if stamp and key != Node.fkey else rel
+            entries[path] = {'node': node.id, 'ip': node.ip, 'type': key,
+                             'name': name, 'file': rel, 'code': code,
+                             'cached': node.cache_hits.get(dfile, False),
+                             'size': os.path.getsize(dfile),
+                             'sha1': tools.file_sha1(dfile)}
+        return entries
+
+    def manifest_save(self):
+        '''
+        Writes the manifest of outputs and files of this run into outdir,
+        with diff_against also the report of changes against it
+        '''
+        outputs = {}
+        for node in self.sorted_nodes():
+            if not node.filtered_out:
+                outputs.update(self.manifest_entries(node))
+        self.manifest = {'time': datetime.now().isoformat(),
+                         'outputs': outputs}
+        tools.mdir(self.conf['outdir'])
+        fname = os.path.join(self.conf['outdir'], tools.run_manifest)
+        with open(fname, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        if self.diff_base is None:
+            return
+        self.changes = tools.manifest_diff(self.diff_base, self.manifest)
+        fname = os.path.join(self.conf['outdir'], tools.run_changes)
+        with open(fname, 'w') as f:
+            json.dump(self.changes, f, indent=1, sort_keys=True)
+        self.logger.info('changes since %s: %s added, %s changed, %s removed,'
+                         ' %s unchanged' % (self.changes['base'],
+                                            len(self.changes['added']),
+                                            len(self.changes['changed']),
+                                            len(self.changes['removed']),
+                                            self.changes['unchanged']))
+
     @run_with_lock
     def create_archive_general(self, timeout):
-        outfile = os.path.join(self.conf['archive_dir'],
-                               self.conf['archive_name'])
-        cmd = "tar zcf '%s' -C %s %s" % (outfile, self.conf['outdir'], ".")
-        tools.mdir(self.conf['archive_dir'])
-        self.logger.debug("cmd: %s" % cmd)
-        outs, errs, code = tools.launch_cmd(cmd, timeout)
+        if self.archive is None:
+            self.archive_start()
+        if self.diff_base is not None:
+            if self.changes is None:
+                self.manifest_save()
+            outdir = self.conf['outdir']
+            for path in sorted(self.changes['added']):
+                self.archive.add(os.path.join(
+                    outdir, self.changes['added'][path]['file']))
+            for path in sorted(self.changes['changed']):
+                self.archive.add(os.path.join(
+                    outdir, self.changes['changed'][path]['new']['file']))
+            for fname in [tools.run_manifest, tools.run_changes]:
+                self.archive.add(os.path.join(outdir, fname))
+        errs, code = self.archive.close(timeout,
+                                        rest=self.diff_base is None)
+        outfile = self.archive.outfile
+        self.archive = None
         if code != 0:
             self.logger.error("Can't create archive %s" % (errs))
+        else:
+            tools.codec_fix_ext(outfile)
 
     def find_adm_interface_speed(self, defspeed):
         '''Returns interface speed through which logs will be dowloaded'''
@@ -641,61 +1433,176 @@ class NodeManager(object):
                 except:
                     speed = defspeed
                 return speed
+        return defspeed
 
     @run_with_lock
     def get_logs(self, timeout, fake=False, maxthreads=10, speed=100):
         if fake:
             self.logger.info('fake = True, skipping')
             return
-        txtfl = []
-        speed = self.find_adm_interface_speed(speed)
-        speed = int(speed * 0.9 / min(maxthreads, len(self.nodes)))
-        pythonslowpipe = tools.slowpipe % speed
+        self.logs_bandwidth(speed)
         run_items = []
         for node in [n for n in self.nodes.values() if not n.filtered_out]:
             if not node.logs_dict():
                 self.logger.info(("node %s - no logs "
                                   "to collect") % node.id)
                 continue
-            node.archivelogsfile = os.path.join(self.conf['archive_dir'],
-                                                'logs-node-%s.tar.gz' %
-                                                str(node.id))
-            tools.mdir(self.conf['archive_dir'])
-            input = ''
-            for fn in node.logs_dict():
-                input += '%s\0' % fn.lstrip(os.path.abspath(os.sep))
-            cmd = ("tar --gzip -C %s --create --warning=no-file-changed "
-                   " --file - --null --files-from -" % os.path.abspath(os.sep))
-            if not (node.ip == 'localhost' or node.ip.startswith('127.')):
-                cmd = ' '.join([cmd, "| python -c '%s'; exit ${PIPESTATUS}" %
-                                pythonslowpipe])
-            args = {'cmd': cmd,
-                    'timeout': timeout,
-                    'outfile': node.archivelogsfile,
-                    'input': input,
-                    'ok_codes': [0, 1]}
-            run_items.append(tools.RunItem(target=node.exec_simple_cmd,
-                                           args=args))
-        tools.run_batch(run_items, maxthreads)
-        for tfile in txtfl:
-            try:
-                os.remove(tfile)
-            except:
-                self.logger.error("can't delete file %s" % tfile)
+            if self.conf['logs_incremental']:
+                target = node.get_logs_delta
+            else:
+                target = node.get_logs_archive
+            run_items.append(tools.RunItem(target=target,
+                                           args=self.logs_args(node, timeout),
+                                           key=node.ip))
+        self.disk_monitor_start()
+        start = time.time()
+        total = 0
+        try:
+            for key, result in self.run_batch_iter(
+                    run_items, maxthreads, msg='Collecting and packing logs',
+                    phase='logs'):
+                total += self.logs_result(self.nodes[key], result)
+        finally:
+            self.disk_monitor.stop()
+        self.logs_report(total, time.time() - start)
+
+    def logs_bandwidth(self, speed):
+        '''Sets the rate of log transfers via the admin interface'''
+        # speed is in Mbit/s, bucket rate in bytes/s
+        speed = self.find_adm_interface_speed(speed)
+        self.bucket.set_rate(speed * 125000 * self.conf['logs_speed_ratio'])
+        self.logger.info('logs bandwidth: %s Mbit/s' %
+                         (speed * self.conf['logs_speed_ratio']))
+
+    def logs_args(self, node, timeout):
+        '''Returns args of get_logs_archive / get_logs_delta of node'''
+        tools.mdir(self.conf['archive_dir'])
+        if self.conf['logs_incremental']:
+            fname = 'logs-node-%s-delta.tar.%s'
+        else:
+            fname = 'logs-node-%s.tar.%s'
+        fname = fname % (node.id, tools.codec_ext(node.compression))
+        node.archivelogsfile = os.path.join(self.conf['archive_dir'], fname)
+        # local nodes do not use the admin interface
+        bucket = None if tools.is_local(node.ip) else self.bucket
+        return {'outfile': node.archivelogsfile,
+                'timeout': timeout,
+                'bucket': bucket,
+                'monitor': self.disk_monitor}
+
+    def logs_result(self, node, result):
+        '''Records (code, bytes, seconds) of node logs, returns bytes'''
+        code, size, seconds = result
+        if code == tools.DiskMonitor.aborted:
+            self.logs_incomplete.append(node)
+            return size
+        node.archivelogsfile = tools.codec_fix_ext(node.archivelogsfile)
+        node.logs_rate = size / seconds if seconds else 0
+        self.logger.info('node: %s, logs: %s bytes in %.1fs, %.0f B/s' %
+                         (node.id, size, seconds, node.logs_rate))
+        return size
+
+    def logs_report(self, total, elapsed):
+        self.logger.info('logs: %s bytes in %.1fs, aggregate %.0f B/s' %
+                         (total, elapsed, total / elapsed if elapsed else 0))
+        if self.logs_incomplete:
+            self.logger.error('logs of nodes %s not collected, low disk space'
+                              ' in %s' % (sorted(n.id for n in
+                                                 self.logs_incomplete),
+                                          self.conf['archive_dir']))
+
+    def disk_monitor_start(self):
+        if self.conf['logs_free_soft'] or self.conf['logs_free_hard']:
+            self.disk_monitor.start(self.conf['archive_dir'],
+                                    self.conf['logs_free_soft'],
+                                    self.conf['logs_free_hard'])
 
     @run_with_lock
-    def get_files(self, timeout=15):
+    def run_pipeline(self, stages, maxthreads=100, logs_maxthreads=100,
+                     logs_timeout=3600, fake_logs=False, speed=100,
+                     coefficient=1.2):
+        '''
+        Runs stages ("put", "cmds", "files", "logs") of every node as its
+        own chain (Node.run_stages) instead of one phase for all nodes after
+        another - a slow node only delays itself. At most maxthreads nodes
+        run put, commands, files and log size calculation at once, at most
+        logs_maxthreads collect logs, within the logs bandwidth and free
+        space (projected archive sizes of the nodes collecting logs times
+        coefficient must fit). With fake_logs log size is only calculated.
+        '''
+        self.cmds_limit.set_size(maxthreads)
+        self.logs_limit.set_size(logs_maxthreads)
+        collect = 'logs' in stages and not fake_logs
+        if collect:
+            self.logs_bandwidth(speed)
+        run_items = []
+        for key, node in self.nodes.items():
+            if node.filtered_out:
+                continue
+            logs = None
+            if collect:
+                logs = self.logs_args(node, logs_timeout)
+                logs['space'] = (self.conf['archive_dir'], coefficient)
+            run_items.append(tools.RunItem(
+                target=node.run_stages,
+                args={'stages': stages,
+                      'cmds_limit': self.cmds_limit,
+                      'logs_limit': self.logs_limit,
+                      'budget': self.output_budget,
+                      'logs': logs},
+                key=key))
+        if collect:
+            self.disk_monitor_start()
+        start = time.time()
+        total = 0
+        try:
+            # logs_maxthreads workers more than commands may use, for nodes
+            # waiting for a logs slot - the pool is grown to all of them
+            for key, result in self.run_batch_iter(
+                    run_items, maxthreads + (logs_maxthreads if collect
+                                             else 0),
+                    msg='Running nodes'):
+                node = self.nodes[key]
+                if 'cmds' in result:
+                    (node.mapcmds, node.mapscr, node.codes,
+                     node.cache_hits) = result['cmds']
+                    self.archive_add(node, Node.ckey)
+                if 'files' in result:
+                    self.archive_add(node, Node.fkey)
+                if 'scan' in result:
+                    node.logs, node.logs_ratios = result['scan']
+                if 'logs' in result:
+                    total += self.logs_result(node, result['logs'])
+        finally:
+            self.disk_monitor.stop()
+        for limit in [self.cmds_limit, self.logs_limit]:
+            if isinstance(limit, tools.AdaptiveLimiter):
+                self.logger.info(limit.summary())
+        if 'logs' in stages:
+            self.alogsize = sum(sum(n.logs_dict().values())
+                                for n in self.nodes.values()) / 1024
+            self.logger.info('Full log size on nodes(with fuel): %s Kb' %
+                             self.alogsize)
+        if collect:
+            self.logs_report(total, time.time() - start)
+
+    @run_with_lock
+    def get_files(self, timeout=15, maxthreads=10):
         run_items = []
         for n in [n for n in self.nodes.values() if not n.filtered_out]:
-            run_items.append(tools.RunItem(target=n.get_files))
-        tools.run_batch(run_items, 10)
+            run_items.append(tools.RunItem(target=n.get_files, key=n.ip))
+        for key, result in self.run_batch_iter(
+                run_items, maxthreads, msg='Collecting files and filelists',
+                phase='files'):
+            self.archive_add(self.nodes[key], Node.fkey)
 
     @run_with_lock
-    def put_files(self):
+    def put_files(self, maxthreads=10):
         run_items = []
         for n in [n for n in self.nodes.values() if not n.filtered_out]:
-            run_items.append(tools.RunItem(target=n.put_files))
-        tools.run_batch(run_items, 10)
+            run_items.append(tools.RunItem(target=n.put_files, key=n.ip))
+        self.run_batch(run_items, maxthreads, msg='Uploading files',
+                       phase='put')
 
     def has(self, *keys):
         nodes = {}
@@ -23,55 +23,362 @@ import os
 import logging
 import sys
 import threading
-from multiprocessing import Process, Queue, BoundedSemaphore
+import time
+from multiprocessing import Process, Queue, BoundedSemaphore, Pool, Lock
+from multiprocessing import cpu_count
+from multiprocessing.sharedctypes import RawValue, RawArray
+from multiprocessing.pool import ThreadPool
+import Queue as queue
+import copy_reg
+import types
+import resource
 import subprocess
+import shlex
+import re
 import yaml
 import json
 from flock import FLock
 from tempfile import gettempdir
 from pipes import quote
-import urllib2
+import httplib
+import socket
+import uuid
+import errno
+import hashlib
+import tarfile
+import shutil
+from collections import deque
+from tempfile import TemporaryFile
+from distutils.spawn import find_executable
+from contextlib import contextmanager, closing
 
 logger = logging.getLogger(__name__)
-slowpipe = '''
+# reads {"files": [...], "state": {path: [inode, size, mtime]}} from stdin,
+# writes a tar stream of data appended to files since state was recorded
+# (whole file if it was rotated or truncated) and a manifest member. A file
+# which gets shorter while read is padded with NULs up to the size in its
+# member header, "length" in the manifest is what was actually read.
+logs_delta = '''
+import io
+import json
+import os
 import sys
-import time
-while 1:
-    a = sys.stdin.read(int(1250*%s))
-    if a:
-        sys.stdout.write(a)
-        time.sleep(0.01)
-    else:
-        break
+import tarfile
+
+
+class Padded(object):
+    def __init__(self, f):
+        self.f = f
+        self.got = 0
+
+    def read(self, size):
+        data = b""
+        if self.f is not None:
+            try:
+                data = self.f.read(size)
+            except (IOError, OSError):
+                pass
+            if len(data) < size:
+                self.f = None
+        self.got += len(data)
+        return data + b"\\0" * (size - len(data))
+
+
+data = json.load(sys.stdin)
+out = getattr(sys.stdout, "buffer", sys.stdout)
+tar = tarfile.open(fileobj=out, mode="w|")
+manifest = {}
+for path in data["files"]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        continue
+    prev = data["state"].get(path)
+    offset = 0
+    if prev and prev[0] == st.st_ino and prev[1] <= st.st_size:
+        offset = prev[1]
+    length = st.st_size - offset
+    manifest[path] = {"inode": st.st_ino, "size": st.st_size,
+                      "mtime": st.st_mtime, "offset": offset,
+                      "length": length}
+    if not length:
+        continue
+    info = tarfile.TarInfo(path.lstrip("/"))
+    info.size = length
+    info.mtime = st.st_mtime
+    info.mode = st.st_mode & 0o777
+    try:
+        f = open(path, "rb")
+        f.seek(offset)
+    except (IOError, OSError):
+        manifest.pop(path)
+        continue
+    src = Padded(f)
+    tar.addfile(info, src)
+    f.close()
+    if src.got < length:
+        manifest[path].update(size=offset + src.got, length=src.got)
+m = json.dumps(manifest).encode("utf-8")
+info = tarfile.TarInfo(".timmy-delta.json")
+info.size = len(m)
+tar.addfile(info, io.BytesIO(m))
+tar.close()
 '''
+logs_delta_manifest = '.timmy-delta.json'
 
+# reads {"items": [{"path", "include", "exclude", "start"}, ...]} from stdin,
+# walks every path once (nested paths are walked as part of their parent),
+# writes {"dir": [[name, size, mtime, items bitmask], ...]} for every
+# regular file matching at least one item
+logs_inventory = '''
+import json
+import os
+import re
+import stat
+import subprocess
+import sys
+items = json.load(sys.stdin)["items"]
+for item in items:
+    item["path"] = os.path.normpath(item["path"])
+    item["prefix"] = item["path"].rstrip("/") + "/"
+    for k in ["include", "exclude"]:
+        if item.get(k):
+            item[k] = re.compile(item[k])
+    if item.get("start"):
+        out = subprocess.check_output(["date", "-d", item["start"], "+%s"])
+        item["start"] = int(out)
+roots = sorted(set(i["path"] for i in items))
+roots = [r for r in roots
+         if not any(r.startswith(o.rstrip("/") + "/") for o in roots)]
+result = {}
+def check(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if not stat.S_ISREG(st.st_mode):
+        return
+    mask = 0
+    for n, item in enumerate(items):
+        if path != item["path"] and not path.startswith(item["prefix"]):
+            continue
+        if item.get("start") and not st.st_mtime > item["start"]:
+            continue
+        if item.get("include") and not item["include"].search(path):
+            continue
+        if item.get("exclude") and item["exclude"].search(path):
+            continue
+        mask |= 1 << n
+    if mask:
+        d, name = os.path.split(path)
+        result.setdefault(d, []).append([name, st.st_size,
+                                         int(st.st_mtime), mask])
+for root in roots:
+    if not os.path.isdir(root):
+        check(root)
+    for d, dirs, files in os.walk(root):
+        for f in files:
+            check(os.path.join(d, f))
+json.dump(result, sys.stdout, separators=(",", ":"))
+'''
 
-def auth_token(conf):
-    req_data = json.dumps(
-        {'auth':
-            {'scope':
-                {'project':
-                    {'domain': {'id': 'default'},
-                     'name': conf['tenant']}},
-                     'identity':
-             {'password':
-                 {'user':
-                     {'domain': {'id': 'default'},
-                      'password': conf['fuel_pass'],
-                      'name': conf['fuel_user']}},
-                      'methods': ['password']}
-             }
-         }
-    )
-
-    req = urllib2.Request("http://" + conf['fuel_ip'] + ":"
-                          + conf['keystone_port'] + "/v3/auth/tokens",
-                          req_data, {'Content-Type': 'application/json'})
+batch_header = '''
+__timmy_out=$(mktemp)
+__timmy_err=$(mktemp)
+__timmy_run() {
+    local idx=$1 t=$2 start end rc
+    shift 2
+    start=$(date +%%s%%N)
+    timeout "$t" "$@" > "$__timmy_out" 2> "$__timmy_err" < /dev/null
+    rc=$?
+    end=$(date +%%s%%N)
+    printf '%%s %%s %%s %%s %%s %%s\\n' '%s' "$idx" "$rc" \\
+        "$(( (end - start) / 1000000 ))" \\
+        "$(stat -c %%s "$__timmy_out")" "$(stat -c %%s "$__timmy_err")"
+    cat "$__timmy_out" "$__timmy_err"
+}
+'''
+batch_footer = '''
+rm -f "$__timmy_out" "$__timmy_err"
+'''
+
+
+# spans of the run are appended to this file by every worker, see trace_start
+trace_file = None
+
+
+def trace_start(fname):
+    '''
+    Starts recording spans (must be called before workers are started),
+    trace_export writes them to fname
+    '''
+    global trace_file
+    trace_file = fname + '.part'
+    mdir(os.path.dirname(os.path.abspath(fname)))
+    open(trace_file, 'w').close()
+
+
+def trace_event(name, cat, track, start, end, args=None):
+    '''Records a span on track (i.e. "node-1"), times are epoch seconds'''
+    if trace_file is None:
+        return
+    line = json.dumps({'name': name, 'cat': cat, 'track': track,
+                       'ts': int(start * 1000000),
+                       'dur': int((end - start) * 1000000),
+                       'args': args or {}}) + '\n'
+    # a single O_APPEND write keeps lines of concurrent workers whole
+    fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND)
     try:
-        token = urllib2.urlopen(req).info().getheader('X-Subject-Token')
-    except:
-        token = None
-    return token
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def trace_span(name, cat, track, **args):
+    '''
+    Records the block as a span, yields its args dict which the block may
+    update (i.e. with bytes transferred)
+    '''
+    start = time.time()
+    try:
+        yield args
+    finally:
+        trace_event(name, cat, track, start, time.time(), args)
+
+
+def trace_export(fname):
+    '''
+    Writes recorded spans to fname in Chrome trace event format (opens in
+    chrome://tracing, Perfetto UI and similar viewers), one thread per track
+    '''
+    global trace_file
+    if trace_file is None:
+        return
+    events = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass
+    os.remove(trace_file)
+    trace_file = None
+
+    def order(track):
+        # run phases first, then API, then nodes by id
+        num = track.rpartition('-')[2]
+        return (track != 'timmy', track != 'nailgun',
+                int(num) if num.isdigit() else 0, track)
+
+    tids = dict((t, i) for i, t in
+                enumerate(sorted(set(e['track'] for e in events), key=order)))
+    trace = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+              'args': {'name': 'timmy'}}]
+    for track, tid in tids.items():
+        trace.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                      'tid': tid, 'args': {'name': track}})
+        trace.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': 1,
+                      'tid': tid, 'args': {'sort_index': tid}})
+    for e in events:
+        trace.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X',
+                      'ts': e['ts'], 'dur': e['dur'], 'pid': 1,
+                      'tid': tids[e['track']], 'args': e['args']})
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+
+class NailgunClient(object):
+    '''
+    Nailgun/Keystone API client. Authenticates once, keeps HTTP connections
+    alive between requests and caches GET responses, so each API path is
+    fetched only once per run.
+    '''
+
+    def __init__(self, conf, timeout=15, logger=None):
+        self.conf = conf
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.token = None
+        self.connections = {}
+        self.cache = {}
+
+    def request(self, port, method, path, body=None, headers=None):
+        '''Returns (status, response headers, data)'''
+        headers = headers or {}
+        for attempt in range(2):
+            conn = self.connections.get(port)
+            if not conn:
+                conn = httplib.HTTPConnection(self.conf['fuel_ip'], int(port),
+                                              timeout=self.timeout)
+                self.connections[port] = conn
+            try:
+                with trace_span('%s %s' % (method, path), 'api', 'nailgun',
+                                bytes_in=len(body or '')) as span:
+                    conn.request(method, path, body, headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    span.update(status=resp.status, bytes_out=len(data))
+                if resp.getheader('connection', '').lower() == 'close':
+                    self.close(port)
+                return resp.status, resp, data
+            except (httplib.HTTPException, socket.error) as e:
+                # kept-alive connection may have been closed by the server
+                self.close(port)
+                if attempt:
+                    self.logger.error('request %s %s failed: %s' %
+                                      (method, path, e))
+        return None, None, None
+
+    def auth(self):
+        if self.token is None:
+            body = json.dumps(
+                {'auth':
+                    {'scope':
+                        {'project':
+                            {'domain': {'id': 'default'},
+                             'name': self.conf['tenant']}},
+                     'identity':
+                        {'password':
+                            {'user':
+                                {'domain': {'id': 'default'},
+                                 'password': self.conf['fuel_pass'],
+                                 'name': self.conf['fuel_user']}},
+                         'methods': ['password']}}})
+            status, resp, data = self.request(
+                self.conf['keystone_port'], 'POST', '/v3/auth/tokens', body,
+                {'Content-Type': 'application/json'})
+            if resp is not None:
+                self.token = resp.getheader('X-Subject-Token')
+        return self.token
+
+    def get(self, path):
+        '''Returns (status, data) of a Nailgun GET request'''
+        if path not in self.cache:
+            headers = {}
+            token = self.auth()
+            if token:
+                headers['X-Auth-Token'] = token
+            status, resp, data = self.request(self.conf['nailgun_port'],
+                                              'GET', path, None, headers)
+            if status != 200:
+                return status, data
+            self.cache[path] = (status, data)
+        return self.cache[path]
+
+    def get_json(self, path):
+        status, data = self.get(path)
+        if status != 200:
+            return None
+        return json.loads(data)
+
+    def close(self, port=None):
+        ports = [port] if port else self.connections.keys()
+        for p in ports:
+            conn = self.connections.pop(p, None)
+            if conn:
+                conn.close()
 
 
 def interrupt_wrapper(f):
@@ -106,17 +413,37 @@ def run_with_lock(f):
 
 
 class RunItem():
-    def __init__(self, target, args=None, key=None, logger=None):
+    def __init__(self, target, args=None, key=None, logger=None, name=None):
         self.target = target
         self.args = args
         self.key = key
+        self.name = name
         self.process = None
         self.queue = None
         self.logger = logger or logging.getLogger(__name__)
 
 
+class TracedTarget(object):
+    '''
+    run_batch target recording a span of the call on track, with the time
+    it waited for a worker since queued
+    '''
+
+    def __init__(self, target, track, queued):
+        self.target = target
+        self.track = track
+        self.queued = queued
+
+    def __call__(self, **kwargs):
+        delay = round(time.time() - self.queued, 6)
+        with trace_span(self.target.__name__, 'task', self.track,
+                        queue_delay=delay):
+            return self.target(**kwargs)
+
+
 class SemaphoreProcess(Process):
-    def __init__(self, semaphore, target, args=None, queue=None, logger=None):
+    def __init__(self, semaphore, target, args=None, queue=None, logger=None,
+                 index=None):
         Process.__init__(self)
         self.logger = logger or logging.getLogger(__name__)
         self.semaphore = semaphore
@@ -125,59 +452,1070 @@ class SemaphoreProcess(Process):
             args = {}
         self.args = args
         self.queue = queue
+        self.index = index
+
+    def put(self, result):
+        if self.queue:
+            if self.index is not None:
+                result = (self.index, result)
+            self.queue.put_nowait(result)
 
     def run(self):
         try:
-            result = self.target(**self.args)
-            if self.queue:
-                self.queue.put_nowait(result)
+            self.put(self.target(**self.args))
         except Exception as error:
             self.logger.exception(error)
-            if self.queue:
-                self.queue.put_nowait(error)
+            self.put(error)
         finally:
             self.logger.debug('finished call: %s' % self.target)
             self.semaphore.release()
             self.logger.debug('semaphore released')
 
 
-def run_batch(item_list, maxthreads, dict_result=False):
+class Progress(object):
+    '''Live progress line of a run_batch call'''
+
+    def __init__(self, item_list, msg='', stream=None, slowest=3):
+        self.names = {}
+        for idx, run_item in enumerate(item_list):
+            self.names[idx] = str(run_item.name or run_item.key or idx)
+        self.total = len(item_list)
+        self.msg = msg
+        self.stream = stream or sys.stdout
+        self.slowest = slowest
+        self.started = {}
+        self.done = 0
+        self.start_time = time.time()
+        self.width = 0
+
+    def start(self, idx):
+        self.started[idx] = time.time()
+
+    def finish(self, idx):
+        self.started.pop(idx, None)
+        self.done += 1
+        self.show()
+
+    def show(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed else 0
+        line = '%s: %s/%s nodes, %.1f nodes/s' % (self.msg, self.done,
+                                                  self.total, rate)
+        waiting = sorted(self.started.items(), key=lambda x: x[1])
+        if waiting:
+            line += ', slowest: %s' % ', '.join(
+                ['%s (%ds)' % (self.names[idx], now - t)
+                 for idx, t in waiting[:self.slowest]])
+        self.stream.write('\r%s' % line.ljust(self.width))
+        self.stream.flush()
+        self.width = len(line)
+
+    def close(self):
+        self.stream.write('\r%s\r' % (' ' * self.width))
+        self.stream.flush()
+
+
+def _reduce_method(m):
+    return getattr, (m.im_self, m.im_func.__name__)
+
+
+# bound methods are run_batch targets, allow passing them to pool processes
+copy_reg.pickle(types.MethodType, _reduce_method)
+
+run_backends = ['fork', 'thread', 'process', 'gevent']
+_pools = {}
+_pool_sizes = {}
+# set once the gevent backend is used, launch_cmd then cooperates with the
+# gevent event loop instead of blocking
+green = False
+
+
+def get_pool(backend, size):
+    '''
+    Returns a long-lived worker pool of at least size workers, creating it
+    on first use and replacing it (once idle) by a bigger one if needed
+    '''
+    if backend in _pools and _pool_sizes[backend] < size:
+        pool = _pools.pop(backend)
+        pool.close()
+        pool.join()
+    if backend not in _pools:
+        logger = logging.getLogger(__name__)
+        logger.debug('starting %s pool, %s workers' % (backend, size))
+        if backend == 'thread':
+            _pools[backend] = ThreadPool(size)
+        else:
+            _pools[backend] = Pool(size)
+        _pool_sizes[backend] = size
+    return _pools[backend]
+
+
+def close_pools(terminate=False):
+    for pool in _pools.values():
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    _pools.clear()
+    _pool_sizes.clear()
+
+
+def _run_target(target, args):
+    try:
+        return target(**args)
+    except Exception as error:
+        logging.getLogger(__name__).exception(error)
+        return error
+
+
+def run_batch(item_list, maxthreads, dict_result=False, backend='fork',
+              pool_size=None, progress=None, limiter=None, errors=None):
+    '''
+    Runs targets of RunItems in parallel, at most maxthreads at a time and
+    returns their results in the order of item_list (or as a dict by key),
+    None for items which failed. See run_batch_iter for the backends.
+    '''
+    results = {}
+    for run_item, result in run_batch_iter(item_list, maxthreads,
+                                           backend=backend,
+                                           pool_size=pool_size,
+                                           progress=progress,
+                                           limiter=limiter,
+                                           errors=errors):
+        results[id(run_item)] = result
+    if dict_result:
+        result = {}
+        for run_item in item_list:
+            result[run_item.key] = results.get(id(run_item))
+        return result
+    else:
+        return [results.get(id(run_item)) for run_item in item_list]
+
+
+def run_batch_iter(item_list, maxthreads, backend='fork', pool_size=None,
+                   progress=None, limiter=None, errors=None):
+    '''
+    Runs targets of RunItems in parallel, at most maxthreads at a time, and
+    yields (run_item, result) in the order the items finish.
+    backend "fork" starts a new process per item, "thread" and "process"
+    send items to a long-lived pool of pool_size (at least maxthreads)
+    workers which is reused by subsequent calls. "gevent" runs all items as
+    greenlets of a single process driven by the gevent event loop.
+    If progress is a message string, a live progress line is printed.
+    With limiter (Limiter) targets only run when it lets them.
+    Items whose target raises an exception are not yielded, the exception
+    is logged and added to errors (dict by key) if given.
+    '''
+    logger = logging.getLogger(__name__)
+    if progress is not None:
+        progress = Progress(item_list, progress)
+    run_list = item_list
+    if limiter is not None:
+        run_list = [RunItem(target=LimitedTarget(i.target, limiter),
+                            args=i.args, key=i.key, name=i.name)
+                    for i in run_list]
+    if trace_file is not None:
+        queued = time.time()
+        run_list = [RunItem(target=TracedTarget(i.target,
+                                                str(i.name or i.key),
+                                                queued),
+                            args=i.args, key=i.key, name=i.name)
+                    for i in run_list]
+    if backend == 'fork':
+        results = _run_batch_fork(run_list, maxthreads, progress)
+    elif backend == 'gevent':
+        results = _run_batch_gevent(run_list, maxthreads, progress)
+    else:
+        # fewer workers would silently lower maxthreads
+        pool = get_pool(backend, max(pool_size, maxthreads))
+        results = _run_batch_pool(run_list, maxthreads, pool, progress)
+    try:
+        for idx, result in results:
+            if progress:
+                progress.finish(idx)
+            run_item = item_list[idx]
+            if isinstance(result, Exception):
+                logger.error('%s failed: %s' % (run_item.name or run_item.key,
+                                                result))
+                if errors is not None:
+                    errors[run_item.key] = result
+                continue
+            yield run_item, result
+    finally:
+        if progress:
+            progress.close()
+
+
+def _run_batch_pool(item_list, maxthreads, pool, progress=None):
+    semaphore = threading.BoundedSemaphore(maxthreads)
+    done = queue.Queue()
+    pending = {}
+
+    def callback(idx):
+        def f(result):
+            semaphore.release()
+            done.put((idx, result))
+        return f
+
+    def collect():
+        while True:
+            try:
+                return done.get(timeout=1)
+            except queue.Empty:
+                if progress:
+                    progress.show()
+                # errors outside of target (i.e. pickling) skip callback
+                for idx, async_result in pending.items():
+                    if async_result.ready() and not async_result.successful():
+                        try:
+                            async_result.get()
+                        except Exception as error:
+                            pending.pop(idx)
+                            semaphore.release()
+                            return idx, error
+
+    try:
+        for idx, run_item in enumerate(item_list):
+            while not semaphore.acquire(False):
+                result = collect()
+                pending.pop(result[0], None)
+                yield result
+            if progress:
+                progress.start(idx)
+            pending[idx] = pool.apply_async(_run_target,
+                                            (run_item.target,
+                                             run_item.args or {}),
+                                            callback=callback(idx))
+        while pending:
+            result = collect()
+            pending.pop(result[0], None)
+            yield result
+    except (KeyboardInterrupt, GeneratorExit):
+        close_pools(terminate=True)
+        raise
+
+
+def _run_batch_gevent(item_list, maxthreads, progress=None):
+    global green
+    logger = logging.getLogger(__name__)
+    try:
+        import gevent
+        from gevent.pool import Pool as GreenPool
+        from gevent.queue import Queue as GreenQueue, Empty
+    except ImportError:
+        logger.critical('run_backend gevent requires gevent module')
+        sys.exit(1)
+    green = True
+    # every concurrent command needs a few pipes
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard and soft < maxthreads * 4:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, resource.error):
+            logger.warning('could not raise open files limit')
+    pool = GreenPool(maxthreads)
+    done = GreenQueue()
+
+    def run(idx, run_item):
+        if progress:
+            progress.start(idx)
+        done.put((idx, _run_target(run_item.target, run_item.args or {})))
+
+    def feed():
+        for idx, run_item in enumerate(item_list):
+            pool.spawn(run, idx, run_item)
+
+    feeder = gevent.spawn(feed)
+    try:
+        for count in range(len(item_list)):
+            while True:
+                try:
+                    result = done.get(timeout=1)
+                    break
+                except Empty:
+                    if progress:
+                        progress.show()
+            yield result
+    except (KeyboardInterrupt, GeneratorExit):
+        feeder.kill()
+        pool.kill()
+        raise
+
+
+def _run_batch_fork(item_list, maxthreads, progress=None):
     def cleanup():
         logger = logging.getLogger(__name__)
         logger.debug('cleanup processes')
         for run_item in item_list:
             if run_item.process:
                 run_item.process.terminate()
-    logger = logging.getLogger(__name__)
     semaphore = BoundedSemaphore(maxthreads)
+    done = Queue()
+    started = 0
     try:
-        for run_item in item_list:
-            semaphore.acquire(True)
-            run_item.queue = Queue()
+        for idx, run_item in enumerate(item_list):
+            while not semaphore.acquire(False):
+                try:
+                    idx_done, result = done.get(timeout=0.1)
+                except queue.Empty:
+                    if progress:
+                        progress.show()
+                    continue
+                item_list[idx_done].process.join()
+                item_list[idx_done].process = None
+                started -= 1
+                yield idx_done, result
+            if progress:
+                progress.start(idx)
             p = SemaphoreProcess(target=run_item.target,
                                  semaphore=semaphore,
                                  args=run_item.args,
-                                 queue=run_item.queue)
+                                 queue=done,
+                                 index=idx)
             run_item.process = p
             p.start()
-        for run_item in item_list:
-            run_item.result = run_item.queue.get()
-            if isinstance(run_item.result, Exception):
-                logger.critical('%s, exiting' % run_item.result)
-                cleanup()
-                sys.exit(42)
-            run_item.process.join()
-            run_item.process = None
-        if dict_result:
-            result = {}
-            for run_item in item_list:
-                result[run_item.key] = run_item.result
-            return result
-        else:
-            return [run_item.result for run_item in item_list]
-    except KeyboardInterrupt:
+            started += 1
+        while started:
+            try:
+                idx_done, result = done.get(timeout=1)
+            except queue.Empty:
+                if progress:
+                    progress.show()
+                continue
+            item_list[idx_done].process.join()
+            item_list[idx_done].process = None
+            started -= 1
+            yield idx_done, result
+    except (KeyboardInterrupt, GeneratorExit):
         cleanup()
-        raise KeyboardInterrupt()
+        raise
+
+
+class SSHMux(object):
+    '''Multiplexed master ssh connection to a single node.
+
+    ssh, scp and rsync calls given this object are sent through the master
+    connection via ControlPath. Every call is counted in a stats file next to
+    the control socket so that counts done by run_batch workers are visible
+    to the parent process.'''
+
+    def __init__(self, ip, ssh_opts, ctl_dir, persist=600):
+        self.ip = ip
+        if type(ssh_opts) is list:
+            ssh_opts = ' '.join(ssh_opts)
+        self.ssh_opts = ssh_opts or ''
+        self.path = os.path.join(ctl_dir, 'mux-%s' % ip)
+        self.stats_file = self.path + '.stats'
+        self.persist = persist
+
+    def _record(self, kind):
+        try:
+            fd = os.open(self.stats_file,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            os.write(fd, kind)
+            os.close(fd)
+        except OSError:
+            pass
+
+    def opts(self):
+        '''Returns ssh options for a call via master and counts the call'''
+        if os.path.exists(self.path):
+            self._record('r')
+        else:
+            # master is gone, ssh will connect directly
+            self._record('h')
+        return '-oControlMaster=no -oControlPath=%s' % self.path
+
+    def start(self, timeout=15):
+        cmd = ("ssh -M -N -f -oControlMaster=yes"
+               " -oControlPath='%s' -oControlPersist=%s %s '%s'"
+               " < /dev/null > /dev/null 2>&1") % (self.path, self.persist,
+                                                   self.ssh_opts, self.ip)
+        outs, errs, code = _observed(time.time(), launch_cmd(cmd, timeout))
+        if code == 0 and os.path.exists(self.path):
+            self._record('h')
+            return True
+        return False
+
+    def stop(self, timeout=15):
+        cmd = ("ssh -O exit -oControlPath='%s' '%s'"
+               " < /dev/null > /dev/null 2>&1") % (self.path, self.ip)
+        launch_cmd(cmd, timeout)
+
+    def stats(self):
+        '''Returns (handshakes, reused) counts'''
+        try:
+            with open(self.stats_file, 'r') as f:
+                data = f.read()
+        except IOError:
+            data = ''
+        return data.count('h'), data.count('r')
+
+
+_shared = {}
+
+
+def _shared_lookup(shared_id):
+    return _shared[shared_id]
+
+
+class Shared(object):
+    '''
+    Base for objects kept in shared memory. They work with all run_batch
+    backends: threads and gevent share the object, forked workers inherit it.
+    When pickled for pool processes only an id is sent, which is looked up in
+    the copy the pool process inherited - so such objects must be created
+    before the pool is started (i.e. in NodeManager.__init__).
+    '''
+
+    def __init__(self):
+        self.shared_id = uuid.uuid4().hex
+        _shared[self.shared_id] = self
+
+    def __reduce__(self):
+        return _shared_lookup, (self.shared_id,)
+
+
+def sleep(seconds):
+    if green:
+        import gevent
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+class TokenBucket(Shared):
+    '''
+    Limits aggregate transfer rate (bytes per second) of all streams which
+    consume from the bucket. A stream takes tokens for what it has already
+    read and sleeps off the debt, so the whole budget is always shared by
+    the streams still running. rate 0 means unlimited.
+    '''
+
+    def __init__(self, rate=0, burst=0.1):
+        Shared.__init__(self)
+        self.lock = Lock()
+        self.rate = RawValue('d', rate)
+        self.burst = burst
+        self.tokens = RawValue('d', 0)
+        self.stamp = RawValue('d', time.time())
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate.value = rate
+            self.tokens.value = 0
+            self.stamp.value = time.time()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.time()
+            rate = self.rate.value
+            if rate <= 0:
+                return
+            tokens = self.tokens.value + (now - self.stamp.value) * rate
+            tokens = min(tokens, rate * self.burst) - size
+            self.tokens.value = tokens
+            self.stamp.value = now
+        if tokens < 0:
+            sleep(-tokens / rate)
+
+
+class DiskMonitor(Shared):
+    '''
+    Watches free space (percent) of the filesystem streams are written to.
+    Streams (launch_cmd_stream) register while running. Below the soft
+    watermark new streams wait, below the hard watermark new streams are
+    not started and the largest running stream is stopped every interval
+    until free space is above it again. Stopped streams remove their
+    output and return code DiskMonitor.aborted.
+    '''
+    aborted = -2
+    slots = 4096
+
+    def __init__(self):
+        Shared.__init__(self)
+        self.lock = Lock()
+        # 0 - ok, 1 - below soft watermark, 2 - below hard watermark
+        self.state = RawValue('i', 0)
+        self.used = RawArray('b', self.slots)
+        self.stop_flags = RawArray('b', self.slots)
+        self.sizes = RawArray('d', self.slots)
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def start(self, path, soft, hard, interval=1):
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       args=(path, soft, hard, interval))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+        self.state.value = 0
+
+    def free(self, path):
+        st = os.statvfs(path)
+        return 100.0 * st.f_bavail / st.f_blocks if st.f_blocks else 100
+
+    def run(self, path, soft, hard, interval):
+        while self.running:
+            try:
+                free = self.free(path)
+            except OSError as e:
+                self.logger.warning('cannot check free space: %s' % e)
+                free = 100
+            state = 2 if free < hard else 1 if free < soft else 0
+            if state != self.state.value:
+                self.logger.warning('%.1f%% free in %s, streams %s' %
+                                    (free, path, ['resumed', 'paused',
+                                                  'stopped'][state]))
+            self.state.value = state
+            if state == 2:
+                self.stop_largest()
+            time.sleep(interval)
+
+    def stop_largest(self):
+        with self.lock:
+            running = [i for i in range(self.slots)
+                       if self.used[i] and not self.stop_flags[i]]
+            if running:
+                largest = max(running, key=lambda i: self.sizes[i])
+                self.stop_flags[largest] = 1
+
+    def enter(self, timeout):
+        '''
+        Waits while below the soft watermark (at most timeout seconds).
+        Returns a slot to pass to update/leave, or None if the stream must
+        not be started.
+        '''
+        deadline = time.time() + timeout
+        while self.state.value:
+            if self.state.value == 2 or time.time() > deadline:
+                return None
+            sleep(0.5)
+        with self.lock:
+            for i in range(self.slots):
+                if not self.used[i]:
+                    self.used[i] = 1
+                    self.stop_flags[i] = 0
+                    self.sizes[i] = 0
+                    return i
+        # no free slot - the stream is not tracked
+        return -1
+
+    def update(self, slot, size):
+        '''Records size written by the stream, returns False to stop it'''
+        if slot < 0:
+            return True
+        self.sizes[slot] += size
+        return not self.stop_flags[slot]
+
+    def leave(self, slot):
+        if slot >= 0:
+            self.used[slot] = 0
+
+
+class Limiter(Shared):
+    '''
+    Limits how many workers of any run_batch backend are in a section at
+    once (size 0 - no limit). A worker may reserve an amount of a resource
+    (i.e. disk space) while in the section, see acquire.
+    '''
+
+    def __init__(self, size=0):
+        Shared.__init__(self)
+        self.lock = Lock()
+        self.size = RawValue('i', size)
+        self.count = RawValue('i', 0)
+        self.reserved = RawValue('d', 0)
+
+    def set_size(self, size):
+        self.size.value = size
+
+    def acquire(self, reserve=0, available=None):
+        '''
+        Waits for a place in the section. With available (a function
+        returning how much of the resource is left), also waits until
+        reserve fits in it along with what workers in the section have
+        reserved. Returns False if it can not fit even with the section
+        empty.
+        '''
+        while True:
+            with self.lock:
+                size = self.size.value
+                if not size or self.count.value < size:
+                    if (available is None or
+                            self.reserved.value + reserve <= available()):
+                        self.count.value += 1
+                        self.reserved.value += reserve
+                        return True
+                    if not self.count.value:
+                        return False
+            sleep(0.1)
+
+    def release(self, reserve=0):
+        with self.lock:
+            self.count.value -= 1
+            self.reserved.value -= reserve
+
+    @contextmanager
+    def section(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+# (seconds, exit code) of remote calls by worker (thread or greenlet), see
+# observe and AdaptiveLimiter
+_observations = {}
+
+
+def _worker_id():
+    if green:
+        import gevent
+        return id(gevent.getcurrent())
+    return threading.current_thread().ident
+
+
+def observe(seconds, code):
+    '''Records a remote call made by the current worker'''
+    calls = _observations.setdefault(_worker_id(), deque(maxlen=1000))
+    calls.append((seconds, code))
+
+
+def observations():
+    '''Returns and forgets remote calls of the current worker'''
+    return list(_observations.pop(_worker_id(), []))
+
+
+def _observed(start, result):
+    observe(time.time() - start, result[2])
+    return result
+
+
+def remote_call(call, health=None, retry=True):
+    '''
+    Makes a remote call (a function returning outs, errs, code) of a node,
+    with health (NodeHealth) retried (if retry) and skipped when the node
+    is down. Calls of local nodes (no ssh) should go without health.
+    '''
+    if health is not None:
+        return health.run(call, retry)
+    return _observed(time.time(), call())
+
+
+class AdaptiveLimiter(Limiter):
+    '''
+    Limiter which adapts its size (up to maximum, see set_size) to remote
+    calls made in the section (see observe): it grows while they succeed
+    - doubling per round at first, then by one per round - and is halved
+    (at most once per round) on ssh failures and timeouts, when calls get
+    slower than latency_factor times the best seen (if latency) or local
+    load average per CPU is above max_load.
+    '''
+    failure_codes = (255, 124)
+
+    def __init__(self, name, initial=10, minimum=2, latency=True,
+                 latency_factor=3, max_load=2.0):
+        Limiter.__init__(self)
+        self.name = name
+        self.initial = initial
+        self.minimum = minimum
+        self.latency = latency
+        self.latency_factor = latency_factor
+        self.max_load = max_load
+        self.cpus = cpu_count()
+        self.level = RawValue('d', 0)
+        self.maximum = RawValue('i', 0)
+        self.slow_start = RawValue('b', 1)
+        self.ewma = RawValue('d', 0)
+        self.best = RawValue('d', 0)
+        self.done = RawValue('i', 0)
+        self.hold = RawValue('i', 0)
+        self.low = RawValue('i', 0)
+        self.high = RawValue('i', 0)
+        self.logger = logging.getLogger(__name__)
+
+    def set_size(self, maximum):
+        '''Resets the limiter for a phase of at most maximum workers'''
+        with self.lock:
+            self.maximum.value = maximum
+            self.level.value = max(min(self.initial, maximum), 1)
+            self.size.value = int(self.level.value)
+            self.low.value = self.high.value = self.size.value
+            self.slow_start.value = 1
+            self.ewma.value = self.best.value = 0
+            self.done.value = self.hold.value = 0
+
+    def summary(self):
+        return ('concurrency of %s: %s..%s, last %s' %
+                (self.name, self.low.value, self.high.value,
+                 self.size.value))
+
+    def acquire(self, reserve=0, available=None):
+        observations()
+        return Limiter.acquire(self, reserve, available)
+
+    def release(self, reserve=0):
+        Limiter.release(self, reserve)
+        self.record(observations())
+
+    def record(self, calls):
+        if not calls:
+            return
+        failed = len([c for s, c in calls if c in self.failure_codes])
+        seconds = sum(s for s, c in calls) / len(calls)
+        try:
+            load = os.getloadavg()[0] / self.cpus
+        except OSError:
+            load = 0
+        reason = None
+        with self.lock:
+            old = self.size.value
+            ewma = self.ewma.value
+            ewma = 0.8 * ewma + 0.2 * seconds if ewma else seconds
+            self.ewma.value = ewma
+            if not self.best.value or ewma < self.best.value:
+                self.best.value = ewma
+            if failed:
+                reason = '%s of %s calls failed' % (failed, len(calls))
+            elif load > self.max_load:
+                reason = 'load %.1f per cpu' % load
+            elif (self.latency and
+                  ewma > self.best.value * self.latency_factor):
+                reason = 'calls take %.2fs, best %.2fs' % (ewma,
+                                                           self.best.value)
+            self.done.value += 1
+            level = self.level.value
+            if reason:
+                if self.done.value < self.hold.value:
+                    reason = None
+                else:
+                    level = max(level / 2, self.minimum)
+                    self.slow_start.value = 0
+                    # next decrease only after the current ones finish
+                    self.hold.value = self.done.value + self.count.value
+            else:
+                level += 1 if self.slow_start.value else 1.0 / level
+            level = max(min(level, self.maximum.value), 1)
+            self.level.value = level
+            self.size.value = int(level)
+            self.low.value = min(self.low.value, self.size.value)
+            self.high.value = max(self.high.value, self.size.value)
+            new = self.size.value
+        if reason and new != old:
+            self.logger.warning('concurrency of %s: %s -> %s, %s' %
+                                (self.name, old, new, reason))
+        elif new != old:
+            self.logger.debug('concurrency of %s: %s -> %s' %
+                              (self.name, old, new))
+
+
+class NodeHealth(Shared):
+    '''
+    Connection health of a node, shared by all run_batch backends. Remote
+    calls (see remote_call) which fail to connect - ssh, scp or rsync fail
+    with an ssh connection error in stderr - are retried up to retries
+    times, after delay seconds doubled on every attempt. After failures_max
+    failed attempts in a row the node is down: its remaining calls are not
+    made, they return code 255 (as ssh) at once. Calls failing otherwise,
+    even with code 255 of the remote command, are not retried.
+    '''
+    skipped_code = 255
+    connect_errors = re.compile(
+        r'ssh: connect to host|ssh: Could not resolve hostname|'
+        r'kex_exchange_identification|ssh_exchange_identification|'
+        r'Connection (refused|timed out|reset by peer|closed by remote host)|'
+        r'No route to host')
+
+    def __init__(self, name, retries=2, delay=1, failures_max=3):
+        Shared.__init__(self)
+        self.name = name
+        self.retries = retries
+        self.delay = delay
+        self.failures_max = failures_max
+        self.lock = Lock()
+        self.failures = RawValue('i', 0)
+        self.is_down = RawValue('b', 0)
+        self.skipped = RawValue('i', 0)
+        self.logger = logging.getLogger(__name__)
+
+    def down(self):
+        return bool(self.is_down.value)
+
+    def connect_failed(self, result):
+        outs, errs, code = result
+        return bool(code and self.connect_errors.search(errs or ''))
+
+    def run(self, call, retry=True):
+        if self.down():
+            with self.lock:
+                self.skipped.value += 1
+            return '', '%s is down, skipped' % self.name, self.skipped_code
+        attempt = 0
+        while True:
+            start = time.time()
+            result = _observed(start, call())
+            if not self.connect_failed(result):
+                with self.lock:
+                    self.failures.value = 0
+                return result
+            with self.lock:
+                self.failures.value += 1
+                if (self.failures.value >= self.failures_max and
+                        not self.is_down.value):
+                    self.is_down.value = 1
+                    self.logger.warning('%s is down after %s failed'
+                                        ' connections, skipping the rest of'
+                                        ' its calls' %
+                                        (self.name, self.failures.value))
+            if self.down() or not retry or attempt >= self.retries:
+                return result
+            delay = self.delay * 2 ** attempt
+            attempt += 1
+            self.logger.info('%s: connection failed, retry %s of %s in %ss' %
+                             (self.name, attempt, self.retries, delay))
+            sleep(delay)
+
+
+class LimitedTarget(object):
+    '''run_batch target which runs within a Limiter'''
+
+    def __init__(self, target, limiter):
+        self.target = target
+        self.limiter = limiter
+        self.__name__ = getattr(target, '__name__', 'target')
+
+    def __call__(self, **kwargs):
+        self.limiter.acquire()
+        try:
+            return self.target(**kwargs)
+        finally:
+            self.limiter.release()
+
+
+def free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+# compression codecs; "cmd" compresses stdin to stdout at a given level,
+# "magic" identifies the format of a received file
+codec_names = ['gzip', 'pigz', 'zstd', 'lz4']
+codecs = {'gzip': {'cmd': 'gzip -c -%s', 'level': 6, 'max': 9,
+                   'levels': [1, 6, 9], 'ext': 'gz', 'magic': '\x1f\x8b'},
+          'pigz': {'cmd': 'pigz -c -%s', 'level': 6, 'max': 9,
+                   'levels': [1, 6, 9], 'ext': 'gz', 'magic': '\x1f\x8b'},
+          'zstd': {'cmd': 'zstd -q -c -T0 -%s', 'level': 3, 'max': 19,
+                   'levels': [1, 3, 9, 19], 'ext': 'zst',
+                   'magic': '\x28\xb5\x2f\xfd'},
+          'lz4': {'cmd': 'lz4 -q -c -%s', 'level': 1, 'max': 12,
+                  'levels': [1, 9], 'ext': 'lz4',
+                  'magic': '\x04\x22\x4d\x18'}}
+
+
+# files with these extensions hardly compress any further
+compressed_exts = ('.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip')
+
+
+def is_compressed(fname):
+    return fname.endswith(compressed_exts)
+
+
+def codec_check(name, level=None):
+    '''Returns an error message if codec name or level is not valid'''
+    if name not in codecs:
+        return 'unknown codec %s, use one of: %s' % (
+            name, ', '.join(codec_names))
+    if level is not None and not 1 <= level <= codecs[name]['max']:
+        return 'codec %s level must be 1-%s' % (name, codecs[name]['max'])
+
+
+def codec_cmd(name, level=None):
+    '''
+    Returns a shell command compressing stdin to stdout with codec name,
+    falling back to gzip where the codec is not installed - the format of
+    the result can be found by codec_detect.
+    '''
+    cmd = codecs[name]['cmd'] % (level or codecs[name]['level'])
+    if name == 'gzip':
+        return cmd
+    fallback = codecs['gzip']['cmd'] % codecs['gzip']['level']
+    return ('if command -v %s >/dev/null 2>&1; then %s; else %s; fi' %
+            (name, cmd, fallback))
+
+
+# appended to a bash "producer | compressor" pipeline: exits with the code
+# of the producer, or 125 if the compressor (or its fallback) failed - its
+# codes could be taken for acceptable codes of the producer (tar: 1)
+pipe_exit = '; s=(${PIPESTATUS[@]}); exit $((s[1] ? 125 : s[0]))'
+
+
+def codec_ext(name):
+    return codecs[name]['ext']
+
+
+def codec_detect(fname):
+    '''Returns name of the codec used to compress fname or None'''
+    try:
+        with open(fname, 'rb') as f:
+            head = f.read(4)
+    except IOError:
+        return None
+    for name in codec_names:
+        if head.startswith(codecs[name]['magic']):
+            return name
+
+
+def codec_fix_ext(fname):
+    '''
+    Renames "<name>.tar.<ext>" to match the format of its content (a node
+    might have fallen back to gzip), returns the resulting filename.
+    '''
+    name = codec_detect(fname)
+    base, ext = os.path.splitext(fname)
+    if (name is None or not base.endswith('.tar') or
+            ext[1:] == codec_ext(name)):
+        return fname
+    newname = '%s.%s' % (base, codec_ext(name))
+    os.rename(fname, newname)
+    return newname
+
+
+@contextmanager
+def codec_open(fname):
+    '''Yields a file object with decompressed content of fname'''
+    name = codec_detect(fname) or 'gzip'
+    if name == 'pigz':
+        name = 'gzip'
+    with open(os.devnull, 'w') as devnull:
+        p = popen([name, '-d', '-c', fname], stdout=subprocess.PIPE,
+                  stderr=devnull)
+    try:
+        yield p.stdout
+    finally:
+        p.stdout.close()
+        p.wait()
+
+
+def codec_benchmark(path='/var/log', sample=64 * 1024 * 1024, level=None):
+    '''
+    Compresses up to sample bytes of files found under path with every
+    codec installed locally, at its typical levels or at level.
+    Returns a list of (codec, level, ratio, MB/s of input, sample size).
+    '''
+    data = TemporaryFile()
+    # cap every file so that the sample is not made of a single log
+    for root, dirs, files in os.walk(path):
+        for fname in sorted(files):
+            left = sample - data.tell()
+            if left <= 0:
+                break
+            fpath = os.path.join(root, fname)
+            if not os.path.isfile(fpath) or os.path.islink(fpath):
+                continue
+            try:
+                with open(fpath, 'rb') as f:
+                    data.write(f.read(min(left, sample // 16)))
+            except (IOError, OSError):
+                pass
+    size = data.tell()
+    results = []
+    for name in codec_names:
+        if not size or not find_executable(name):
+            continue
+        for lvl in [level] if level else codecs[name]['levels']:
+            if lvl > codecs[name]['max']:
+                continue
+            data.seek(0)
+            start = time.time()
+            p = subprocess.Popen(codecs[name]['cmd'] % lvl, shell=True,
+                                 stdin=data, stdout=subprocess.PIPE,
+                                 close_fds=True)
+            out = 0
+            for chunk in iter(lambda: p.stdout.read(65536), ''):
+                out += len(chunk)
+            p.wait()
+            elapsed = time.time() - start
+            results.append((name, lvl, float(size) / out if out else 0,
+                            size / elapsed / 1024 / 1024, size))
+    data.close()
+    return results
+
+
+class ArchiveWriter(object):
+    '''
+    Compressed tar archive of rootdir which is built while it is being
+    populated: paths passed to add() are packed right away by a tar process
+    reading them from stdin. close() adds whatever was not added yet and
+    finalizes the archive.
+    '''
+
+    def __init__(self, outfile, rootdir, codec='gzip', level=None,
+                 exclude=None):
+        self.outfile = outfile
+        self.rootdir = rootdir
+        self.codec = codec
+        self.level = level
+        # added paths and paths (relative to rootdir) not to archive
+        self.added = set(exclude or [])
+        self.p = None
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        # started on first use so that gevent backend is already active
+        cmd = "tar cf - -C '%s' --null --files-from - | %s > '%s'%s" % (
+            self.rootdir, codec_cmd(self.codec, self.level), self.outfile,
+            pipe_exit)
+        self.logger.debug('cmd: %s' % cmd)
+        self.errf = TemporaryFile()
+        self.p = popen(cmd, stdin=subprocess.PIPE, stderr=self.errf,
+                       executable='/bin/bash')
+
+    def add(self, path):
+        rel = os.path.relpath(path, self.rootdir)
+        if rel in self.added or not os.path.exists(path):
+            return
+        if self.p is None:
+            self.start()
+        self.added.add(rel)
+        self.p.stdin.write(rel + '\0')
+        self.p.stdin.flush()
+
+    def add_rest(self):
+        for root, dirs, files in os.walk(self.rootdir):
+            rel = os.path.relpath(root, self.rootdir)
+            if rel in self.added:
+                dirs[:] = []
+                continue
+            for f in files:
+                self.add(os.path.join(root, f))
+
+    def close(self, timeout, rest=True):
+        '''Adds whatever was not added yet if rest, returns (stderr, code)'''
+        if rest:
+            self.add_rest()
+        if self.p is None:
+            self.start()
+        self.p.stdin.close()
+        deadline = time.time() + timeout
+        while self.p.poll() is None and time.time() < deadline:
+            sleep(0.1)
+        if self.p.poll() is None:
+            os.killpg(self.p.pid, 9)
+            self.p.wait()
+        self.errf.seek(0)
+        errs = self.errf.read()
+        self.errf.close()
+        return errs, self.p.returncode
 
 
 def get_dir_structure(rootdir):
@@ -253,135 +1591,647 @@ def mdir(directory):
             sys.exit(3)
 
 
-def launch_cmd(cmd, timeout, input=None, ok_codes=None):
+def cmd_str(cmd):
+    if isinstance(cmd, basestring):
+        return cmd
+    return ' '.join(quote(a) for a in cmd)
+
+
+def popen(cmd, **kwargs):
+    '''
+    Starts cmd - a shell command string or an argv list, run without a
+    shell - as the leader of a new process group. Pipes of commands started
+    by other threads at the same time are not inherited, they would keep
+    them open (i.e. ssh ControlMaster daemons) and stall their readers.
+    '''
+    if green:
+        from gevent.subprocess import Popen
+    else:
+        Popen = subprocess.Popen
+    return Popen(cmd, shell=isinstance(cmd, basestring),
+                 preexec_fn=os.setsid, close_fds=True, **kwargs)
+
+
+class GroupKiller(object):
+    '''
+    Terminates the process group of p (see popen) after timeout seconds:
+    SIGTERM, then SIGKILL if anything is left after grace seconds. With
+    gevent a Timeout is raised in the current greenlet instead, the
+    caller has to call kill().
+    '''
+
+    def __init__(self, p, timeout, grace=2):
+        self.p = p
+        self.grace = grace
+        self.fired = False
+        if green:
+            from gevent import Timeout
+            self.timer = Timeout.start_new(timeout)
+        else:
+            self.timer = threading.Timer(timeout, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def kill(self):
+        self.fired = True
+        try:
+            os.killpg(self.p.pid, 15)
+        except OSError:
+            return
+        logger = logging.getLogger(__name__)
+        logger.error('pid %d killed by timeout' % self.p.pid)
+        # returncode is set once the caller (or gevent) has reaped p
+        deadline = time.time() + self.grace
+        while self.p.returncode is None and time.time() < deadline:
+            sleep(0.05)
+        try:
+            os.killpg(self.p.pid, 9)
+        except OSError:
+            pass
+
+    def cancel(self):
+        self.timer.cancel()
+        if not green:
+            # do not leave timer threads behind in pool workers
+            self.timer.join()
+
+
+def launch_cmd(cmd, timeout, input=None, ok_codes=None, infile=None,
+               outfile=None):
+    '''
+    Runs cmd (shell command string or argv list). stdin is input, or the
+    content of infile. stdout is returned, or written to outfile. After
+    timeout the process group is killed and code is 124, as with timeout(1).
+    Returns (stdout, stderr, code).
+    '''
     def _log_msg(cmd, stderr, code, debug=False, stdin=None, stdout=None):
         message = ('launch_cmd:\n'
                    '___command: %s\n'
                    '______code: %s\n'
-                   '____stderr: %s' % (cmd, code, stderr))
+                   '____stderr: %s' % (cmd_str(cmd), code, stderr))
         if debug:
             message += '\n_____stdin: %s\n' % stdin
             message += '____stdout: %s' % stdout
         return message
 
-    def _timeout_terminate(pid):
-        logger = logging.getLogger(__name__)
-        try:
-            os.kill(pid, 15)
-            logger.error("launch_cmd: pid %d killed by timeout" % pid)
-        except:
-            pass
-
     logger = logging.getLogger(__name__)
-    logger.info('cmd %s' % cmd)
-    p = subprocess.Popen(cmd,
-                         shell=True,
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    timeout_killer = None
+    logger.info('cmd %s' % cmd_str(cmd))
+    fin = open(infile, 'rb') if infile is not None else None
+    fout = open(outfile, 'wb') if outfile is not None else None
+    try:
+        p = popen(cmd,
+                  stdin=fin or subprocess.PIPE,
+                  stdout=fout or subprocess.PIPE,
+                  stderr=subprocess.PIPE)
+    finally:
+        for f in [fin, fout]:
+            if f:
+                f.close()
+    if fin:
+        input = None
+    killer = GroupKiller(p, timeout)
     try:
-        timeout_killer = threading.Timer(timeout, _timeout_terminate, [p.pid])
-        timeout_killer.start()
         outs, errs = p.communicate(input=input)
-        outs = outs.decode('utf-8')
-        errs = errs.decode('utf-8')
-        errs = errs.rstrip('\n')
     except:
-        try:
-            p.kill()
-        except:
-            pass
+        killer.kill()
         p.stdin = None
         outs, errs = p.communicate()
-        outs = outs.decode('utf-8')
-        errs = errs.decode('utf-8')
-        errs = errs.rstrip('\n')
-        logger.error(_log_msg(cmd, errs, p.returncode))
     finally:
-        if timeout_killer:
-            timeout_killer.cancel()
-    logger.info(_log_msg(cmd, errs, p.returncode))
+        killer.cancel()
+    outs = (outs or '').decode('utf-8')
+    errs = errs.decode('utf-8').rstrip('\n')
+    code = 124 if killer.fired else p.returncode
+    if killer.fired:
+        logger.error(_log_msg(cmd, errs, code))
+    logger.info(_log_msg(cmd, errs, code))
     input = input.decode('utf-8') if input else None
-    logger.debug(_log_msg(cmd, errs, p.returncode, debug=True,
+    logger.debug(_log_msg(cmd, errs, code, debug=True,
                           stdin=input, stdout=outs))
-    if p.returncode:
-        if not ok_codes or p.returncode not in ok_codes:
-            logger.warning(_log_msg(cmd, errs, p.returncode))
-    return outs, errs, p.returncode
+    if code:
+        if not ok_codes or code not in ok_codes:
+            logger.warning(_log_msg(cmd, errs, code))
+    return outs, errs, code
+
+
+def launch_cmd_stream(cmd, timeout, outfile, input=None, ok_codes=None,
+                      bucket=None, chunk=65536, monitor=None, infile=None):
+    '''
+    Like launch_cmd (stdin is input or the content of infile), but stdout
+    is written to outfile chunk by chunk as it is read, and every chunk is
+    taken from the bucket (TokenBucket) if given - a slow reader throttles
+    the remote side via ssh/TCP.
+    outfile is a path or an object with write() and close() methods.
+    If monitor (DiskMonitor) stops the stream, outfile path is removed.
+    Returns ('', stderr, code).
+    '''
+    logger = logging.getLogger(__name__)
+    logger.info('cmd %s' % cmd_str(cmd))
+    slot = -1
+    if monitor:
+        slot = monitor.enter(timeout)
+        if slot is None:
+            logger.warning('launch_cmd_stream: not started, low disk space:'
+                           ' %s' % cmd_str(cmd))
+            return '', 'not started: low disk space', DiskMonitor.aborted
+    stopped = False
+    errf = TemporaryFile()
+    fin = open(infile, 'rb') if infile is not None else None
+    try:
+        p = popen(cmd,
+                  stdin=fin or subprocess.PIPE,
+                  stdout=subprocess.PIPE,
+                  stderr=errf)
+    finally:
+        if fin:
+            fin.close()
+
+    def feed():
+        if p.stdin is None:
+            return
+        try:
+            if input:
+                p.stdin.write(input)
+        except IOError:
+            pass
+        finally:
+            p.stdin.close()
+
+    if green:
+        import gevent
+        feeder = gevent.spawn(feed)
+    else:
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+    killer = GroupKiller(p, timeout)
+    is_path = isinstance(outfile, basestring)
+    f = open(outfile, 'wb') if is_path else outfile
+    try:
+        while True:
+            data = p.stdout.read(chunk)
+            if not data:
+                break
+            f.write(data)
+            if bucket:
+                bucket.consume(len(data))
+            if monitor and not monitor.update(slot, len(data)):
+                stopped = True
+                os.killpg(p.pid, 9)
+                break
+        p.wait()
+    except:
+        killer.kill()
+        p.wait()
+    finally:
+        killer.cancel()
+        feeder.join()
+        f.close()
+        if monitor:
+            monitor.leave(slot)
+    errf.seek(0)
+    errs = errf.read().decode('utf-8', 'replace').rstrip('\n')
+    errf.close()
+    if stopped and is_path:
+        os.remove(outfile)
+        logger.warning('launch_cmd_stream: stopped, low disk space: %s' %
+                       cmd_str(cmd))
+        return '', 'stopped: low disk space', DiskMonitor.aborted
+    code = 124 if killer.fired else p.returncode
+    logger.info('launch_cmd_stream: code: %s, stderr: %s' % (code, errs))
+    if code:
+        if not ok_codes or code not in ok_codes:
+            logger.warning('launch_cmd_stream: command: %s, code: %s,'
+                           ' stderr: %s' % (cmd_str(cmd), code, errs))
+    return '', errs, code
 
 
 def ssh_node(ip, command='', ssh_opts=None, env_vars=None, timeout=15,
              filename=None, inputfile=None, outputfile=None,
-             ok_codes=None, input=None, prefix=None):
+             ok_codes=None, input=None, prefix=None, mux=None, bucket=None,
+             monitor=None, health=None):
+    '''
+    Runs command on node ip via ssh (or bash for local nodes), without
+    a local shell. filename is a script piped to "bash -s", inputfile is
+    sent to stdin instead of input, outputfile (a path or a writer, see
+    launch_cmd_stream) receives stdout. With health (NodeHealth) failed
+    connections are retried unless output goes to a writer.
+    '''
     logger = logging.getLogger(__name__)
     if not ssh_opts:
-        ssh_opts = ''
+        ssh_opts = []
+    if type(ssh_opts) is not list:
+        ssh_opts = shlex.split(ssh_opts)
+    if mux:
+        ssh_opts = ssh_opts + shlex.split(mux.opts())
     if not env_vars:
         env_vars = ''
-    if type(ssh_opts) is list:
-        ssh_opts = ' '.join(ssh_opts)
     if type(env_vars) is list:
         env_vars = ' '.join(env_vars)
-    if (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.'):
+    if filename is not None:
+        command = 'bash -s'
+        inputfile = filename
+        logger.info("inputfile selected: %s" % filename)
+    command = '%s %s' % (prefix or '', command)
+    if is_local(ip):
         logger.info("skip ssh")
-        bstr = "%s timeout '%s' bash -c " % (
-               env_vars, timeout)
+        # no connection to fail
+        health = None
+        if env_vars:
+            command = 'export %s; %s' % (env_vars, command)
+        cmd = ['bash', '-c', command]
     else:
         logger.info("exec ssh")
-        bstr = "timeout '%s' ssh -t -T %s '%s' '%s' " % (
-               timeout, ssh_opts, ip, env_vars)
-    if filename is None:
-        cmd = '%s %s' % (bstr, quote(prefix + ' ' + command))
-        if inputfile is not None:
-            '''inputfile and stdin will not work together,
-            give priority to inputfile'''
-            input = None
-            cmd = "%s < '%s'" % (cmd, inputfile)
+        cmd = ['ssh', '-t', '-T'] + ssh_opts + [ip, env_vars, command]
+    if inputfile is not None:
+        '''inputfile and stdin will not work together,
+        give priority to inputfile'''
+        input = None
+    # a writer can not be rewound for another attempt
+    retry = outputfile is None or isinstance(outputfile, basestring)
+    if outputfile is not None and (bucket is not None or
+                                   monitor is not None or
+                                   not isinstance(outputfile, basestring)):
+        return remote_call(lambda: launch_cmd_stream(cmd, timeout, outputfile,
+                                                     input=input,
+                                                     ok_codes=ok_codes,
+                                                     bucket=bucket,
+                                                     monitor=monitor,
+                                                     infile=inputfile),
+                           health, retry)
+    return remote_call(lambda: launch_cmd(cmd, timeout, input=input,
+                                          ok_codes=ok_codes,
+                                          infile=inputfile,
+                                          outfile=outputfile),
+                       health, retry)
+
+
+def batch_script(items):
+    '''
+    Builds a bash script which runs the given (timeout, code) items one by
+    one in a single remote session. Output of each item is framed by a header
+    line: boundary, item index, exit code, duration in ms, stdout and stderr
+    sizes in bytes. Returns (script, boundary).
+    '''
+    boundary = 'TIMMY-%s' % uuid.uuid4().hex
+    script = batch_header % boundary
+    for idx, (timeout, code) in enumerate(items):
+        script += '__timmy_run %s %s bash -c %s\n' % (idx, timeout,
+                                                      quote(code))
+    script += batch_footer
+    return script, boundary
+
+
+class BatchDemux(object):
+    '''
+    Demultiplexes output of a batch_script run while it is streamed (see
+    launch_cmd_stream): stdout of item idx is written to writers[idx].
+    results gets index: (errs, code, duration) of every completed item.
+    '''
+
+    def __init__(self, boundary, writers, errs_max=65536):
+        self.header = boundary + ' '
+        self.writers = writers
+        self.errs_max = errs_max
+        self.results = {}
+        self.buf = ''
+        # [idx, stdout left, stderr left, code, duration, stderr]
+        self.item = None
+
+    def write(self, data):
+        self.buf += data
+        while True:
+            if self.item is None:
+                start = self.buf.find(self.header)
+                if start == -1:
+                    # the tail may be the beginning of a header
+                    self.buf = self.buf[-len(self.header):]
+                    return
+                eol = self.buf.find('\n', start)
+                if eol == -1:
+                    self.buf = self.buf[start:]
+                    return
+                try:
+                    idx, code, duration, osize, esize = [
+                        int(x) for x in
+                        self.buf[start + len(self.header):eol].split()]
+                except ValueError:
+                    self.buf = self.buf[eol:]
+                    continue
+                self.buf = self.buf[eol + 1:]
+                self.item = [idx, osize, esize, code, duration, '']
+            item = self.item
+            if item[1]:
+                data, self.buf = self.buf[:item[1]], self.buf[item[1]:]
+                item[1] -= len(data)
+                if data and 0 <= item[0] < len(self.writers):
+                    self.writers[item[0]].write(data)
+                if item[1]:
+                    return
+            if item[2]:
+                data, self.buf = self.buf[:item[2]], self.buf[item[2]:]
+                item[2] -= len(data)
+                item[5] = (item[5] + data)[:self.errs_max]
+                if item[2]:
+                    return
+            self.results[item[0]] = (item[5], item[3], item[4])
+            self.item = None
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class OutputBudget(Shared):
+    '''Bytes of command outputs which may still be kept in this run'''
+
+    def __init__(self, size):
+        Shared.__init__(self)
+        self.lock = Lock()
+        self.left = RawValue('d', size)
+
+    def take(self, size):
+        '''Returns how many of size bytes may be kept'''
+        with self.lock:
+            size = int(min(size, self.left.value))
+            self.left.value -= size
+        return size
+
+
+class CappedWriter(object):
+    '''
+    Writes a stream to path keeping at most cap bytes (0 - no limit): the
+    first and the last cap / 2 bytes with a marker in between. Kept bytes
+    are also taken from budget (OutputBudget) if given - once it runs out,
+    only the tail it still allows is kept. With store (OutputStore) the
+    content is hashed while written and path is stored in it on close.
+    '''
+
+    def __init__(self, path, cap=0, budget=None, tail=1048576, store=None):
+        self.path = path
+        self.budget = budget
+        self.store = store
+        self.hash = hashlib.sha1() if store else None
+        self.head_left = cap - cap // 2 if cap else float('inf')
+        self.tail_max = cap // 2 if cap else tail
+        self.tail = deque()
+        self.tail_size = 0
+        self.dropped = 0
+        self.f = None
+
+    def open(self):
+        if self.store and os.path.lexists(self.path):
+            # may be a link to a stored blob, which must not change
+            os.unlink(self.path)
+        self.f = open(self.path, 'wb')
+
+    def _write(self, data):
+        self.f.write(data)
+        if self.hash:
+            self.hash.update(data)
+
+    def write(self, data):
+        if self.f is None:
+            self.open()
+        if self.head_left:
+            n = int(min(len(data), self.head_left))
+            if self.budget:
+                taken = self.budget.take(n)
+                if taken < n:
+                    self.head_left = 0
+                n = taken
+            if n:
+                self._write(data[:n])
+                self.head_left = max(self.head_left - n, 0)
+            data = data[n:]
+        if not data:
+            return
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.tail_max:
+            extra = self.tail_size - self.tail_max
+            if len(self.tail[0]) <= extra:
+                chunk = self.tail.popleft()
+                self.tail_size -= len(chunk)
+                self.dropped += len(chunk)
+            else:
+                self.tail[0] = self.tail[0][extra:]
+                self.tail_size -= extra
+                self.dropped += extra
+
+    def close(self):
+        if self.f is None:
+            self.open()
+        tail = ''.join(self.tail)
+        if tail and self.budget:
+            n = self.budget.take(len(tail))
+            self.dropped += len(tail) - n
+            tail = tail[len(tail) - n:]
+        if self.dropped:
+            self._write('\n[... %s bytes skipped ...]\n' % self.dropped)
+        self._write(tail)
+        self.f.close()
+        if self.store:
+            self.store.add(self.path, self.hash.hexdigest())
+
+
+class OutputStore(object):
+    '''
+    Content addressed store of outputs: every distinct content is kept
+    once as a blob named by its sha1, outputs are hard links to blobs.
+    Must be on the same filesystem as the outputs.
+    '''
+    dirname = '.store'
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+
+    def blob(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, path, digest):
+        '''Makes path a link to the blob of its content (digest)'''
+        blob = self.blob(digest)
+        mdir(os.path.dirname(blob))
+        try:
+            os.link(path, blob)
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                self.logger.warning('cannot store %s: %s' % (path, e))
+                return
+        tmp = '%s.%s' % (path, uuid.uuid4().hex)
+        try:
+            os.link(blob, tmp)
+            os.rename(tmp, path)
+        except OSError as e:
+            # i.e. too many links - keep the copy
+            self.logger.warning('cannot link %s to %s: %s' % (path, blob, e))
+
+    def gc(self):
+        '''Removes blobs no output links to, returns bytes freed'''
+        freed = 0
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                blob = os.path.join(root, f)
+                try:
+                    st = os.stat(blob)
+                    if st.st_nlink == 1:
+                        os.remove(blob)
+                        freed += st.st_size
+                except OSError:
+                    pass
+        return freed
+
+
+class ResultCache(object):
+    '''
+    Outputs of remote commands kept in path for reuse while not older than
+    their ttl, by key (see key) - "<key>" holds the output and "<key>.json"
+    its metadata (time, exit code, name).
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts)).hexdigest()
+
+    def get(self, key, ttl):
+        '''Returns (output file, metadata) if key is cached within ttl'''
+        fname = os.path.join(self.path, key)
+        try:
+            with open(fname + '.json', 'r') as f:
+                meta = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if time.time() - meta['time'] > ttl or not os.path.isfile(fname):
+            return None
+        return fname, meta
+
+    def put(self, key, output, **meta):
+        '''Stores a copy of the output file with meta'''
+        mdir(self.path)
+        fname = os.path.join(self.path, key)
+        tmp = '%s.%s' % (fname, uuid.uuid4().hex)
+        meta['time'] = time.time()
+        try:
+            shutil.copyfile(output, tmp)
+            os.rename(tmp, fname)
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, fname + '.json')
+        except (IOError, OSError) as e:
+            logging.getLogger(__name__).warning('cannot cache %s: %s' %
+                                                (output, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+run_manifest = 'manifest.json'
+run_changes = 'changes.json'
+
+
+def file_sha1(fname, chunk=1048576):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for data in iter(lambda: f.read(chunk), ''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def manifest_load(path):
+    '''
+    Returns the run manifest found at path: a manifest file, an outdir of
+    a run or an archive of a run
+    '''
+    if os.path.isdir(path):
+        path = os.path.join(path, run_manifest)
+    manifest = None
+    if codec_detect(path) is None:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
     else:
-        cmd = "%s'%s bash -s' < '%s'" % (bstr, prefix, filename)
-        logger.info("inputfile selected, cmd: %s" % cmd)
-    if outputfile is not None:
-        cmd = "%s > '%s'" % (cmd, outputfile)
-    cmd = ("input=\"$(cat | xxd -p)\"; trap 'kill $pid' 15; " +
-           "trap 'kill $pid' 2; echo -n \"$input\" | xxd -r -p | " + cmd +
-           ' &:; pid=$!; wait $!')
-    return launch_cmd(cmd, timeout, input=input, ok_codes=ok_codes)
+        with codec_open(path) as f:
+            with closing(tarfile.open(fileobj=f, mode='r|')) as tar:
+                for member in tar:
+                    if os.path.normpath(member.name) == run_manifest:
+                        manifest = json.loads(tar.extractfile(member).read())
+                        break
+        if manifest is None:
+            raise IOError('no %s in %s' % (run_manifest, path))
+    # i.e. some other json file - would only fail when compared
+    if type(manifest) is not dict or 'outputs' not in manifest:
+        raise KeyError('no outputs in %s' % path)
+    return manifest
+
+
+def manifest_diff(old, new):
+    '''
+    Compares outputs of two run manifests, returns a report listing
+    added, changed and removed outputs - a changed output has "old"
+    and "new" entries, others have their manifest entry.
+    '''
+    old_o = old['outputs']
+    new_o = new['outputs']
+    report = {'base': old.get('time'), 'time': new.get('time'),
+              'added': {}, 'changed': {}, 'removed': {}, 'unchanged': 0}
+    for path, entry in new_o.items():
+        if path not in old_o:
+            report['added'][path] = entry
+        elif (entry['sha1'], entry['code']) != (old_o[path]['sha1'],
+                                                old_o[path]['code']):
+            report['changed'][path] = {'old': old_o[path], 'new': entry}
+        else:
+            report['unchanged'] += 1
+    for path in set(old_o) - set(new_o):
+        report['removed'][path] = old_o[path]
+    return report
 
 
-def get_files_rsync(ip, data, ssh_opts, dpath, timeout=15):
+def get_files_rsync(ip, data, ssh_opts, dpath, timeout=15, mux=None,
+                    health=None):
     logger = logging.getLogger(__name__)
     if type(ssh_opts) is list:
         ssh_opts = ' '.join(ssh_opts)
+    if mux:
+        ssh_opts = '%s %s' % (ssh_opts, mux.opts())
     if (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.'):
         logger.info("skip ssh rsync")
-        cmd = ("timeout '%s' rsync -avzr --files-from=- / '%s'"
-               " --progress --partial --delete-before" %
-               (timeout, dpath))
+        health = None
+        cmd = ("rsync -avzr --files-from=- / '%s'"
+               " --progress --partial --delete-before" % dpath)
     else:
-        cmd = ("timeout '%s' rsync -avzr -e 'ssh %s"
+        cmd = ("rsync -avzr -e 'ssh %s"
                " -oCompression=no' --files-from=- '%s':/ '%s'"
                " --progress --partial --delete-before"
-               ) % (timeout, ssh_opts, ip, dpath)
+               ) % (ssh_opts, ip, dpath)
     logger.debug("command:%s\ndata:\n%s" % (cmd, data))
     if data == '':
         return cmd, '', 127
-    return launch_cmd(cmd, timeout, input=data)
+    return remote_call(lambda: launch_cmd(cmd, timeout, input=data), health)
 
 
-def get_file_scp(ip, file, ddir, timeout=600, recursive=False):
+def get_file_scp(ip, file, ddir, timeout=600, recursive=False, mux=None,
+                 health=None):
     dest = os.path.split(os.path.normpath(file).lstrip(os.path.sep))[0]
     ddir = os.path.join(os.path.normpath(ddir), dest)
     mdir(ddir)
     r = '-r ' if recursive else ''
-    cmd = "timeout '%s' scp %s'%s':'%s' '%s'" % (timeout, r, ip, file, ddir)
-    return launch_cmd(cmd, timeout)
+    if mux:
+        r = '%s %s' % (mux.opts(), r)
+    cmd = "scp %s'%s':'%s' '%s'" % (r, ip, file, ddir)
+    return remote_call(lambda: launch_cmd(cmd, timeout), health)
 
 
-def put_file_scp(ip, file, dest, timeout=600, recursive=True):
+def put_file_scp(ip, file, dest, timeout=600, recursive=True, mux=None,
+                 health=None):
     r = '-r ' if recursive else ''
-    cmd = "timeout '%s' scp %s'%s' '%s':'%s'" % (timeout, r, file, ip, dest)
-    return launch_cmd(cmd, timeout)
+    if mux:
+        r = '%s %s' % (mux.opts(), r)
+    cmd = "scp %s'%s' '%s':'%s'" % (r, file, ip, dest)
+    return remote_call(lambda: launch_cmd(cmd, timeout), health)
 
 
 def free_space(destdir, timeout):
@@ -390,6 +2240,10 @@ def free_space(destdir, timeout):
     return launch_cmd(cmd, timeout)
 
 
+def is_local(ip):
+    return (ip in ['localhost', '127.0.0.1']) or ip.startswith('127.')
+
+
 # wrap non-list into list
 def w_list(value):
     return value if type(value) == list else [value]